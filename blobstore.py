@@ -0,0 +1,98 @@
+import hashlib
+import logging
+import os
+import tempfile
+from typing import *
+
+import nuconfig
+
+log = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """A store of immutable binary objects, addressed by the sha256 of their content.
+    Storing the same content twice keeps a single copy."""
+
+    name = "none"
+
+    @staticmethod
+    def key(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def put(self, data: bytes) -> str:
+        """Store some data if it's not already there, and return its key."""
+        raise NotImplementedError()
+
+    def get(self, key: str) -> bytes:
+        """Return the data stored under a key, raising KeyError if there is none."""
+        raise NotImplementedError()
+
+    def path(self, key: str) -> Optional[str]:
+        """Return the path of the file holding the data, to serve it without reading it in memory.
+        None if the store doesn't keep its objects in local files."""
+        return None
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError()
+
+
+class LocalBlobStore(BlobStore):
+    """A directory of files named after their sha256, split in subdirectories by the first characters of the key:
+    ab/cd/abcd0123...ef"""
+
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root: str = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        # Keys are used as file names, never accept anything but a sha256
+        if len(key) != 64 or not all(c in "0123456789abcdef" for c in key):
+            raise KeyError(key)
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def put(self, data: bytes) -> str:
+        key = self.key(data)
+        path = self.path(key)
+        if os.path.isfile(path):
+            return key
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first, so that readers never see a partial file
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(data)
+            # mkstemp only lets the owner read the file
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+        return key
+
+    def get(self, key: str) -> bytes:
+        try:
+            with open(self.path(key), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+
+STORES: Dict[str, Callable[[dict], BlobStore]] = {
+    "local": lambda images_cfg: LocalBlobStore(images_cfg["store_path"]),
+}
+
+
+def from_config(cfg: nuconfig.NuConfig) -> BlobStore:
+    """Open the blob store selected in the [Images] section of the config."""
+    images_cfg = cfg["Images"]
+    try:
+        factory = STORES[images_cfg["store"]]
+    except KeyError:
+        raise ValueError(f"Unknown image store: {images_cfg['store']}")
+    return factory(images_cfg)
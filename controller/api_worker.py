@@ -2,25 +2,77 @@
 # -*- coding: utf-8 -*-
 import logging
 from flask import jsonify, make_response
-import os
 import logging
 import queue as queuem
 import requests
-import sqlalchemy
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, scoped_session
+import blobstore
 import database as db
-import base64
-import datetime
+import dbruntime
+import exports
+import imaging
+import nuconfig
+import orders
+from typing import *
+import hashlib
+import hmac
+import io
+from flask import send_file
+from exceptions import NotFoundException, BadRequestException, UnauthorizedException
+from utils import image_mimetype
+from controller.catalogue import CatalogueCache, image_url, encode_cursor, decode_cursor
+from controller.idempotency import IdempotencyKeys
 
 
 
 
 log = logging.getLogger(__name__)
 
-# init session
-db_engine = os.environ.get("DB_ENGINE")
-engine = sqlalchemy.create_engine(db_engine)
-session = sqlalchemy.orm.sessionmaker(bind=engine)()
+
+def page_limit(params) -> Optional[int]:
+    """Read the limit of a paginated request. Without a limit the whole list is returned."""
+    limit = params.get('limit')
+    if limit is None:
+        return None
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise BadRequestException('INVALID_PARAMETERS', 'limit must be a number')
+    return min(max(limit, 1), MAX_PAGE_SIZE)
+
+
+def page_position(params, *keys) -> Optional[tuple]:
+    """Read the keyset values stored in the cursor of a paginated request, or None for the first page."""
+    if not params.get('cursor'):
+        return None
+    position = decode_cursor(params['cursor'])
+    values = tuple(position.get(key) for key in keys)
+    for value in values:
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise BadRequestException('INVALID_PARAMETERS', 'invalid cursor')
+    return values
+
+
+# Largest page size accepted by the paginated endpoints
+MAX_PAGE_SIZE = 100
+
+# Seconds the browsers may cache a product image for
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
+# init database, every gunicorn worker creates its own engine on its first request
+cfg = nuconfig.load_config()
+db_runtime = dbruntime.Database(cfg)
+# Every thread serving a request gets its own session, removed by server.teardown_request
+session = scoped_session(db_runtime.session)
+# The product catalogue shared by the request threads of this process
+catalogue = CatalogueCache()
+# 商品图片存储
+blob_store = blobstore.from_config(cfg)
+# The responses replayed to the retries of the requests sent with an Idempotency-Key header
+idempotency_keys = IdempotencyKeys(session,
+                                   ttl=cfg["Api"]["idempotency_ttl"],
+                                   lease=cfg["Api"]["idempotency_lease"],
+                                   sweep_interval=cfg["Api"]["idempotency_sweep_interval"])
 
 
 class ApiWorker(object):
@@ -49,7 +101,6 @@ class ApiWorker(object):
             cart_item.amount = amount
 
         session.commit()
-        session.close()
 
         return {'success': True, 'message': f'{product_id} added to cart.'}
 
@@ -69,7 +120,6 @@ class ApiWorker(object):
 
         session.delete(cart_item)
         session.commit()
-        session.close()
 
         return {'success': True, 'message': f'{product_id} removed from cart.'}
 
@@ -90,19 +140,21 @@ class ApiWorker(object):
 
         cart_list = []
         for item in cart_items:
+            # 只取第一张图片的id，图片本身通过/api/image/<id>获取
+            image = item.product.images.with_entities(db.ProductImage.id).order_by(db.ProductImage.id).first()
             # add product info
             cart_list.append({
                 'product_id': item.product_id,
                 'product_name': item.product.name,
                 'product_price': item.product.price,
                 'product_description': item.product.description,
-                'product_image':  base64.b64encode(item.product.images[0].data).decode('utf-8'),
+                'product_image_id': image.id if image else None,
+                'product_image': image_url(image.id) if image else '',
+                'product_thumbnail': image_url(image.id, 'thumbnail') if image else '',
                 'quantity': item.quantity,
                 'amount': item.amount
             })
 
-        session.close()
-
         return {'success': True, 'cart_list': cart_list}
 
 
@@ -128,145 +180,153 @@ class ApiWorker(object):
                 'order_tracking_number': order.tracking_number or '',
             })
 
-        session.close()
-
         return {'success': True, 'order_list': order_list}
 
-    # 商品列表
-    def product_list(self):
-        products = session.query(db.Product.id, db.Product.name, db.Product.price, db.Product.description, db.ProductImage.data)\
-                        .outerjoin(db.ProductImage, db.Product.id == db.ProductImage.product_id)\
-                        .all()
-
-        if not products:
-            return {'success': True, 'product_list': []}
-
-        product_list = []
-        for product in products:
-            found = False
-            for item in product_list:
-                if item['product_id'] == product.id:
-                    item['product_image'].append(base64.b64encode(product.data).decode('utf-8'))
-                    found = True
-                    break
-
-            if not found:
-                product_list.append({
-                    'product_id': product.id,
-                    'product_name': product.name,
-                    'product_price': product.price,
-                    'product_description': product.description,
-                    'product_image': [base64.b64encode(product.data).decode('utf-8')] if product.data is not None else []
-                })
-
-        session.close()
-
-        return {'success': True, 'product_list': product_list}
+    # 商品图片
+    def product_image(self, image_id, size='full'):
+        if size not in imaging.SIZES:
+            raise BadRequestException('INVALID_PARAMETERS', f"size must be one of {', '.join(imaging.SIZES)}")
+        image = None
+        if size != 'full':
+            image = session.query(db.ProductImageVariant.sha256).filter_by(image_id=image_id, size=size).first()
+        # 没有这个尺寸时（原图更小，或者没有安装Pillow）发送原图
+        if image is None:
+            image = session.query(db.ProductImage.sha256).filter_by(id=image_id).first()
+        if image is None:
+            raise NotFoundException('NOT_FOUND', 'image not found')
+
+        path = blob_store.path(image.sha256) if image.sha256 is not None else None
+        if path is not None:
+            # 直接发送文件，服务器可以用sendfile传输，Last-Modified取文件的修改时间
+            try:
+                with open(path, 'rb') as file:
+                    mimetype = image_mimetype(file.read(16))
+            except FileNotFoundError:
+                raise NotFoundException('NOT_FOUND', 'image not found')
+            file, etag = path, image.sha256
+        else:
+            if image.sha256 is not None:
+                data = blob_store.get(image.sha256)
+                etag = image.sha256
+            else:
+                # 还没有迁移到图片存储的图片
+                data = session.query(db.ProductImage.data).filter_by(id=image_id).scalar()
+                if data is None:
+                    raise NotFoundException('NOT_FOUND', 'image not found')
+                etag = hashlib.md5(data).hexdigest()
+            file, mimetype = io.BytesIO(data), image_mimetype(data)
+
+        # 图片写入后不会再修改，浏览器可以一直缓存
+        response = send_file(file,
+                             mimetype=mimetype,
+                             etag=etag,
+                             max_age=IMAGE_MAX_AGE,
+                             conditional=True)
+        response.cache_control.immutable = True
+        return response
+
+    # 商品列表，传limit时按cursor分页
+    def product_list(self, params):
+        position = page_position(params, 'id')
+        products, next_id = catalogue.get(session).page(position[0] if position else None, page_limit(params))
+        cursor = encode_cursor({'id': next_id}) if next_id is not None else None
+
+        return {'success': True, 'product_list': products, 'next_cursor': cursor}
     
-    # 搜索商品
+    # 搜索商品，按名称和描述的全文索引相关度排序，传limit时按cursor分页
     def search_products(self, params):
-        keyword = params.get('keyword')
-        products = session.query(db.Product.id, db.Product.name, db.Product.price, db.Product.description, db.ProductImage.data)\
-                        .outerjoin(db.ProductImage, db.Product.id == db.ProductImage.product_id)\
-                        .filter(db.Product.name.ilike(f"%{keyword}%"))\
-                        .all()
-
-        if not products:
-            return {'success': True, 'product_list': []}
-
-        product_list = []
-        for product in products:
-            found = False
-            for item in product_list:
-                if item['product_id'] == product.id:
-                    item['product_image'].append(base64.b64encode(product.data).decode('utf-8'))
-                    found = True
-                    break
-
-            if not found:
-                product_list.append({
-                    'product_id': product.id,
-                    'product_name': product.name,
-                    'product_price': product.price,
-                    'product_description': product.description,
-                    'product_image': [base64.b64encode(product.data).decode('utf-8')] if product.data is not None else []
-                })
-
-        session.close()
-
-        return {'success': True, 'product_list': product_list}
+        keyword = params.get('keyword') or ''
+        # The full-text product search supported by the database, its index is kept up to date by the bot
+        product_ids, position = db_runtime.search_index.search(session, keyword, page_position(params, 's', 'id'),
+                                                               page_limit(params))
+        by_id = catalogue.get(session).by_id
+        products = [by_id[product_id] for product_id in product_ids if product_id in by_id]
+        cursor = encode_cursor({'s': position[0], 'id': position[1]}) if position is not None else None
+
+        return {'success': True, 'product_list': products, 'next_cursor': cursor}
 
 
      # 商品详情
     def product_detail(self, params):
         product_id = params.get('product_id')
         product_id = int(product_id)
-        # 查询有问题，改成内存筛选
-        products = session.query(db.Product.id, db.Product.name, db.Product.price, db.Product.description, db.ProductImage.data)\
-                        .outerjoin(db.ProductImage, db.Product.id == db.ProductImage.product_id)\
-                        .all()
-        
-        products = [product for product in products if product.id == product_id]
-
-        if not products:
-            raise ValueError('product not found')
+        # 缓存可用时直接取，否则只查这一个商品，不为详情页加载整个目录
+        snapshot = catalogue.peek(session)
+        if snapshot is not None:
+            result = snapshot.by_id.get(product_id)
+        else:
+            result = catalogue.load_product(session, product_id)
 
-        product_list = []
-        for product in products:
-            found = False
-            for item in product_list:
-                if item['product_id'] == product.id:
-                    item['product_image'].append(base64.b64encode(product.data).decode('utf-8'))
-                    found = True
-                    break
-
-            if not found:
-                product_list.append({
-                    'product_id': product.id,
-                    'product_name': product.name,
-                    'product_price': product.price,
-                    'product_description': product.description,
-                    'product_image': [base64.b64encode(product.data).decode('utf-8')] if product.data is not None else []
-                })
-
-        if not product_list:
+        if result is None:
             raise ValueError('product not found')
 
-        result = product_list[0]
-
-        session.close()
-
         return {'success': True, 'product': result}
 
 
     
     # 根据传来的product_id quantity user_id 创建订单 
     def create_order(self, params):
-        with session as sess:
-            user_id = params.get('user_id')
-            product_id = params.get('product_id')
-            product_id = int(product_id)
-            quantity = params.get('quantity')
-            notes = params.get('notes')
-            if not notes:
-                raise ValueError('请填写备注，并且填写收货信息')
-            if not user_id or not product_id:
-                raise ValueError('User ID and product_id are required.')
-            # 生成订单
-            order = db.Order(user_id=user_id, notes=notes, tracking_number='', creation_date=datetime.datetime.now(), quantity=quantity)
-            sess.add(order)
-            sess.commit()
-            # 查询product
-            product = sess.query(db.Product).filter_by(id=product_id).one()
-            # 生成订单详情
-            order_detail = db.OrderItem(order=order, product=product)
-            sess.add(order_detail)
-            sess.commit()
-
-            # 查询新插入的订单
-            newOrder = sess.query(db.Order).filter_by(order_id=order.order_id).one()     
-
-        return {'success': True, 'order': newOrder}
+        user_id = params.get('user_id')
+        product_id = params.get('product_id')
+        product_id = int(product_id)
+        quantity = params.get('quantity')
+        if quantity is None:
+            quantity = 1
+        notes = params.get('notes')
+        if not notes:
+            raise ValueError('请填写备注，并且填写收货信息')
+        if not user_id or not product_id:
+            raise ValueError('User ID and product_id are required.')
+        # 订单和订单详情在同一个事务里生成，一次提交
+        try:
+            order = orders.create_order(session, user_id=user_id, quantities={product_id: quantity},
+                                        notes=notes, tracking_number='')
+        except orders.OrderError as e:
+            raise BadRequestException('INVALID_PARAMETERS', str(e))
+
+        return {'success': True, 'order': order}
+
+    # 把用户购物车里的全部商品生成一个订单，并清空购物车
+    def checkout(self, params):
+        user_id = params.get('user_id')
+        notes = params.get('notes')
+        if not notes:
+            raise ValueError('请填写备注，并且填写收货信息')
+        if not user_id:
+            raise ValueError('User ID is required.')
+        try:
+            order = orders.checkout_cart(session, user_id=user_id, notes=notes, tracking_number='')
+        except orders.OrderError as e:
+            raise BadRequestException('INVALID_PARAMETERS', str(e))
+
+        return {'success': True, 'order': order}
+
+    # 导出订单，Authorization头需要带上[Api] export_token，文件边查询边写入，不会整个放在内存里
+    def export_orders(self, params, authorization):
+        token = cfg["Api"]["export_token"]
+        if not token:
+            raise NotFoundException('NOT_FOUND', 'export is not enabled')
+        if not hmac.compare_digest((authorization or '').encode(), f'Bearer {token}'.encode()):
+            raise UnauthorizedException('UNAUTHORIZED', 'invalid token')
+        file_format = params.get('format', 'xlsx')
+        if file_format not in exports.WRITERS:
+            raise BadRequestException('INVALID_PARAMETERS', f"format must be one of {', '.join(exports.WRITERS)}")
+        status = params.get('status') or None
+        if status is not None and status not in exports.ORDER_STATUSES:
+            raise BadRequestException('INVALID_PARAMETERS',
+                                      f"status must be one of {', '.join(exports.ORDER_STATUSES)}")
+        try:
+            start = exports.parse_date(params['from']) if params.get('from') else None
+            end = exports.parse_date(params['to']) if params.get('to') else None
+        except ValueError:
+            raise BadRequestException('INVALID_PARAMETERS', 'from and to must be dates like 2024-01-31')
+
+        file = exports.export_orders(session, file_format, status=status, start=start, end=end)
+        # 文件发送完后由werkzeug关闭并删除
+        return send_file(file,
+                         mimetype=exports.MIMETYPES[file_format],
+                         as_attachment=True,
+                         download_name=f'orders.{file_format}')
 
 
 api_worker = ApiWorker()
\ No newline at end of file
@@ -0,0 +1,144 @@
+# controller
+# -*- coding: utf-8 -*-
+import base64
+import bisect
+import json
+import logging
+import threading
+from typing import *
+
+import database as db
+from exceptions import BadRequestException
+
+log = logging.getLogger(__name__)
+
+
+def image_url(image_id: int, size: Optional[str] = None) -> str:
+    """Return the path of the /api/image endpoint serving the given ProductImage, in one of imaging.SIZES."""
+    if size is None:
+        return f"/api/image/{image_id}"
+    return f"/api/image/{image_id}?size={size}"
+
+
+def encode_cursor(position: dict) -> str:
+    """Turn the keyset position of the last returned item into an opaque cursor for the client."""
+    data = json.dumps(position, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> dict:
+    """Get back the keyset position stored in a cursor created by encode_cursor."""
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        position = json.loads(data)
+    except (TypeError, ValueError):
+        raise BadRequestException('INVALID_PARAMETERS', 'invalid cursor')
+    if not isinstance(position, dict):
+        raise BadRequestException('INVALID_PARAMETERS', 'invalid cursor')
+    return position
+
+
+def group_product_rows(rows) -> List[dict]:
+    """Group the (id, name, price, description, image_id) rows of a products/product_images join by product.
+    The products are indexed by id, so each row is handled in constant time and the order of the rows is kept."""
+    products: Dict[int, dict] = {}
+    for row in rows:
+        product = products.get(row.id)
+        if product is None:
+            product = products[row.id] = {
+                'product_id': row.id,
+                'product_name': row.name,
+                'product_price': row.price,
+                'product_description': row.description,
+                'product_image_id': [],
+                'product_image': [],
+                'product_thumbnail': [],
+            }
+        # Products without images are joined to a single row with a null image id
+        if row.image_id is not None:
+            product['product_image_id'].append(row.image_id)
+            product['product_image'].append(image_url(row.image_id))
+            product['product_thumbnail'].append(image_url(row.image_id, 'thumbnail'))
+    return list(products.values())
+
+
+class CatalogueSnapshot:
+    """An immutable copy of the product rows and of their image ids, taken at a given catalogue generation."""
+
+    def __init__(self, generation: int, products: List[dict]):
+        self.generation: int = generation
+        # Sorted by product id, which is the pagination key
+        self.products: List[dict] = products
+        self.ids: List[int] = [product['product_id'] for product in products]
+        self.by_id: Dict[int, dict] = {product['product_id']: product for product in products}
+
+    def __repr__(self):
+        return f"<CatalogueSnapshot {self.generation} with {len(self.products)} products>"
+
+    def page(self, after_id: Optional[int] = None,
+             limit: Optional[int] = None) -> Tuple[List[dict], Optional[int]]:
+        """Return up to limit products with an id greater than after_id.
+        The second value is the id to resume from, or None if there are no more products."""
+        # Seek to the first product after the cursor instead of skipping the previous pages
+        start = bisect.bisect_right(self.ids, after_id) if after_id is not None else 0
+        if limit is None or start + limit >= len(self.products):
+            return self.products[start:], None
+        page = self.products[start:start + limit]
+        return page, page[-1]['product_id']
+
+
+class CatalogueCache:
+    """The catalogue of this process, reloaded whenever the generation stored in the database changes.
+    The bot bumps the generation when a product is edited, so every gunicorn worker notices it on its next request."""
+
+    def __init__(self):
+        self._snapshot: Optional[CatalogueSnapshot] = None
+        self._lock = threading.Lock()
+
+    def get(self, session) -> CatalogueSnapshot:
+        """Return a snapshot of the current catalogue, loading it if the cached one is stale."""
+        # Read the generation before the rows, so a concurrent edit can only cause an extra reload
+        generation = db.CatalogueGeneration.current(session)
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.generation == generation:
+            return snapshot
+        # Only one request thread reloads the catalogue, the others wait for its result
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.generation != generation:
+                snapshot = self._load(session, generation)
+                self._snapshot = snapshot
+        return snapshot
+
+    def peek(self, session) -> Optional[CatalogueSnapshot]:
+        """Return the cached snapshot if it is still current, without ever loading the catalogue."""
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.generation == db.CatalogueGeneration.current(session):
+            return snapshot
+        return None
+
+    def invalidate(self) -> None:
+        """Drop the cached snapshot of this process."""
+        self._snapshot = None
+
+    @staticmethod
+    def _load(session, generation: int) -> CatalogueSnapshot:
+        log.debug(f"Loading catalogue generation {generation}")
+        rows = session.query(db.Product.id, db.Product.name, db.Product.price, db.Product.description,
+                             db.ProductImage.id.label('image_id')) \
+            .outerjoin(db.ProductImage, db.Product.id == db.ProductImage.product_id) \
+            .order_by(db.Product.id, db.ProductImage.id) \
+            .all()
+        return CatalogueSnapshot(generation, group_product_rows(rows))
+
+    @staticmethod
+    def load_product(session, product_id: int) -> Optional[dict]:
+        """Load a single product and its images through a primary key lookup, whatever the size of the catalogue."""
+        rows = session.query(db.Product.id, db.Product.name, db.Product.price, db.Product.description,
+                             db.ProductImage.id.label('image_id')) \
+            .outerjoin(db.ProductImage, db.Product.id == db.ProductImage.product_id) \
+            .filter(db.Product.id == product_id) \
+            .order_by(db.ProductImage.id) \
+            .all()
+        products = group_product_rows(rows)
+        return products[0] if products else None
@@ -0,0 +1,154 @@
+# controller
+# -*- coding: utf-8 -*-
+import datetime
+import hashlib
+import logging
+import secrets
+import threading
+import time
+from functools import wraps
+from typing import *
+
+import sqlalchemy.exc
+from flask import Response, request
+
+import database as db
+from exceptions import BadRequestException, ConflictException
+from utils import exception_decorate
+
+log = logging.getLogger(__name__)
+
+# Header of the key chosen by the client, sent again with every retry of the same request
+HEADER = 'Idempotency-Key'
+# Header added to the responses which are replayed
+REPLAYED_HEADER = 'Idempotent-Replayed'
+# Longest key accepted, it's stored hashed anyway
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyKeys:
+    """The responses to the requests sent with an Idempotency-Key header, kept in the idempotency_keys table.
+    A retry of a request gets the response to the first one back, without running it again. Thread-safe."""
+
+    def __init__(self, session, ttl: float, lease: float, sweep_interval: float):
+        # The scoped session of the request threads
+        self.session = session
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.lease = datetime.timedelta(seconds=lease)
+        self.sweep_interval: float = sweep_interval
+        self._next_sweep: float = 0.0
+        self._sweep_lock = threading.Lock()
+
+    def idempotent(self, func):
+        """Decorate a view returning a JSON response, so that the retries of its requests are answered only once.
+        Requests without the header are handled as usual."""
+
+        @wraps(func)
+        @exception_decorate
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(HEADER)
+            if key is None:
+                return func(*args, **kwargs)
+            if not key or len(key) > MAX_KEY_LENGTH:
+                raise BadRequestException('INVALID_PARAMETERS',
+                                          f'{HEADER} must have between 1 and {MAX_KEY_LENGTH} characters')
+            digest = hashlib.sha256(f'{request.path}\n{key}'.encode('utf-8')).hexdigest()
+            request_hash = hashlib.sha256(request.get_data()).hexdigest()
+            token, replay = self.claim(digest, request_hash)
+            if replay is not None:
+                return replay
+            try:
+                response = func(*args, **kwargs)
+            except BaseException:
+                self.release(digest, token)
+                raise
+            if response.status_code >= 500:
+                # The retries may succeed, let them run the request again
+                self.release(digest, token)
+            else:
+                self.save(digest, token, response)
+            self.sweep()
+            return response
+
+        return wrapper
+
+    def claim(self, digest: str, request_hash: str) -> Tuple[Optional[str], Optional[Response]]:
+        """Mark the request as being handled and return the token of the claim, or return the response to replay
+        if it has been handled already.
+        The claim only lasts for the lease: if the process handling the request dies before saving the response,
+        the retries can take the key over once it has expired. The token keeps the request which lost the key from
+        overwriting the claim of the one which took it over."""
+        now = datetime.datetime.now()
+        token = secrets.token_hex(16)
+        self.session.add(db.IdempotencyKey(key=digest, token=token, request_hash=request_hash,
+                                           expires_at=now + self.lease))
+        try:
+            self.session.commit()
+            return token, None
+        except sqlalchemy.exc.IntegrityError:
+            self.session.rollback()
+        record = self.session.query(db.IdempotencyKey).filter_by(key=digest).one_or_none()
+        if record is not None and record.expires_at <= now:
+            # The response has expired, or the request was abandoned, but the key hasn't been swept yet
+            taken = self.session.query(db.IdempotencyKey) \
+                .filter(db.IdempotencyKey.key == digest, db.IdempotencyKey.expires_at <= now) \
+                .update({'token': token,
+                         'request_hash': request_hash,
+                         'status_code': None,
+                         'response': None,
+                         'expires_at': now + self.lease}, synchronize_session=False)
+            self.session.commit()
+            if taken:
+                return token, None
+            record = None
+        if record is None or record.status_code is None:
+            # Another request with the same key is being handled, or has just failed and can be retried
+            raise ConflictException('REQUEST_IN_PROGRESS', f'a request with the same {HEADER} is being handled')
+        if record.request_hash != request_hash:
+            raise BadRequestException('IDEMPOTENCY_KEY_REUSED', f'{HEADER} was already used for another request')
+        log.debug(f"Replaying the response to the request {digest}")
+        response = Response(record.response, status=record.status_code, mimetype='application/json')
+        response.headers[REPLAYED_HEADER] = 'true'
+        return None, response
+
+    def save(self, digest: str, token: str, response: Response) -> None:
+        """Store the response to replay to the retries of the request, until the TTL of the keys."""
+        # Whatever a failed request left uncommitted must not be committed with the response
+        self.session.rollback()
+        saved = self.session.query(db.IdempotencyKey) \
+            .filter_by(key=digest, token=token) \
+            .update({'status_code': response.status_code,
+                     'response': response.get_data(),
+                     'expires_at': datetime.datetime.now() + self.ttl}, synchronize_session=False)
+        self.session.commit()
+        if not saved:
+            log.warning(f"The claim of the request {digest} expired and was taken over, its response wasn't saved")
+
+    def release(self, digest: str, token: str) -> None:
+        """Forget the request, so that it's run again if it's retried."""
+        self.session.rollback()
+        released = self.session.query(db.IdempotencyKey) \
+            .filter_by(key=digest, token=token) \
+            .delete(synchronize_session=False)
+        self.session.commit()
+        if not released:
+            log.warning(f"The claim of the request {digest} expired and was taken over, it wasn't released")
+
+    def sweep(self) -> None:
+        """Delete the expired keys, at most once every sweep_interval seconds in every process."""
+        now = time.monotonic()
+        if now < self._next_sweep or not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sweep = now + self.sweep_interval
+            deleted = self.session.query(db.IdempotencyKey) \
+                .filter(db.IdempotencyKey.expires_at <= datetime.datetime.now()) \
+                .delete(synchronize_session=False)
+            self.session.commit()
+            log.debug(f"Swept {deleted} expired idempotency keys")
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            # The response has been saved already, the next sweep will delete them
+            self.session.rollback()
+            log.warning(f"Could not sweep the expired idempotency keys: {e}")
+        finally:
+            self._sweep_lock.release()
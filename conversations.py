@@ -0,0 +1,310 @@
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import queue as queuem
+import threading
+import time
+from typing import *
+
+import greenlet
+
+log = logging.getLogger(__name__)
+
+
+class Conversation:
+    """A resumable conversation, with the same interface as a threading.Thread.
+    Instead of blocking an OS thread while waiting for the next update, the conversation runs in a greenlet which is
+    suspended by its queue and resumed by the Lane it belongs to as soon as an update arrives.
+    Subclasses implement the conversation in run(), exactly like they would with a thread."""
+
+    def __init__(self, pool: "ConversationPool", chat_id: int, name: str):
+        self.name: str = name
+        self.lane: Lane = pool.lane_for(chat_id)
+        self.queue: ConversationQueue = ConversationQueue(self)
+        # The greenlet running the conversation, created by the lane when the conversation starts
+        self._greenlet: Optional[greenlet.greenlet] = None
+        # Set while the conversation is suspended waiting for the queue, increased on every wait
+        self._waiting: bool = False
+        self._wait_id: int = 0
+        # Set while the conversation is sleeping, so that new updates don't resume it
+        self._sleeping: bool = False
+        # Set while the conversation waits for a future, which resumes it instead of the updates
+        self._future: Optional[concurrent.futures.Future] = None
+        self._started = threading.Event()
+        self._finished = threading.Event()
+        self._done_callbacks: List[Callable[[], None]] = []
+
+    def run(self):
+        """The conversation code."""
+        raise NotImplementedError()
+
+    def stop(self, reason: str = "", wait: bool = True):
+        """Ask the conversation to end, optionally waiting for it."""
+        raise NotImplementedError()
+
+    def start(self):
+        """Schedule the conversation on its lane."""
+        if self._started.is_set():
+            raise RuntimeError("conversations can only be started once")
+        self._started.set()
+        self.lane.wake(self)
+
+    def join(self, timeout: Optional[float] = None):
+        """Wait for the conversation to end. Must not be called from a conversation of the same lane."""
+        self._finished.wait(timeout)
+
+    def is_alive(self) -> bool:
+        return self._started.is_set() and not self._finished.is_set()
+
+    def add_done_callback(self, callback: Callable[[], None]) -> None:
+        """Call a function when the conversation ends, from the thread of its lane."""
+        self._done_callbacks.append(callback)
+
+    def _ready(self) -> bool:
+        """Whether a wake up of the lane should resume the conversation."""
+        if not self._waiting:
+            return False
+        if self._future is not None:
+            return self._future.done()
+        return not self._sleeping and not self.queue.empty()
+
+    def _main(self):
+        """The function run by the greenlet of the conversation."""
+        try:
+            self.run()
+        # sys.exit() ends the conversation, not the lane
+        except SystemExit:
+            pass
+        except Exception as e:
+            log.error(f"Unhandled exception in {self.name}: {e}", exc_info=True)
+        finally:
+            self._finished.set()
+            self.lane.finished(self)
+            for callback in self._done_callbacks:
+                callback()
+
+
+class ConversationQueue:
+    """The queue of the updates sent to a conversation, with the put and get methods of a queue.Queue.
+    get() must only be called by the conversation itself: it suspends it, leaving its lane free for the others."""
+
+    def __init__(self, conversation: Conversation):
+        self.conversation: Conversation = conversation
+        self._items: Deque = collections.deque()
+
+    def put(self, item) -> None:
+        """Add an update to the queue, resuming the conversation if it is waiting for one. Thread-safe."""
+        self._items.append(item)
+        self.conversation.lane.wake(self.conversation)
+
+    def get(self, timeout: Optional[float] = None):
+        """Return the next update, suspending the conversation until one arrives.
+        Raises queue.Empty if nothing is received within the timeout, in seconds."""
+        if not self._items:
+            self.conversation.lane.wait(self.conversation, timeout)
+        try:
+            return self._items.popleft()
+        except IndexError:
+            raise queuem.Empty()
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+
+class Lane(threading.Thread):
+    """One of the threads of a ConversationPool, running the greenlets of the conversations assigned to it.
+    Only one conversation of a lane runs at a time, until it waits for its next update."""
+
+    def __init__(self, index: int):
+        super().__init__(name=f"Lane {index}", daemon=True)
+        # The conversations to start or resume
+        self._inbox: queuem.Queue = queuem.Queue()
+        # The heap of the (deadline, sequence, wait id, conversation) timeouts of the waiting conversations
+        self._timeouts: List[tuple] = []
+        self._sequence = itertools.count()
+        self._hub: Optional[greenlet.greenlet] = None
+        self._lock = threading.Lock()
+        self.active: int = 0
+
+    def wake(self, conversation: Conversation) -> None:
+        """Ask the lane to start or resume a conversation. Thread-safe."""
+        self._inbox.put(conversation)
+
+    def wait(self, conversation: Conversation, timeout: Optional[float]) -> None:
+        """Suspend the current conversation until it is woken up or the timeout expires."""
+        if greenlet.getcurrent() is not conversation._greenlet:
+            raise RuntimeError("a conversation queue can only be read by its conversation")
+        conversation._wait_id += 1
+        conversation._waiting = True
+        if timeout is not None:
+            heapq.heappush(self._timeouts, (time.monotonic() + timeout, next(self._sequence),
+                                            conversation._wait_id, conversation))
+        # Give control back to the lane, which will switch back here to resume the conversation
+        self._hub.switch()
+
+    def sleep(self, conversation: Conversation, seconds: float) -> None:
+        """Suspend the current conversation for some seconds, even if updates arrive in the meantime."""
+        conversation._sleeping = True
+        try:
+            self.wait(conversation, seconds)
+        finally:
+            conversation._sleeping = False
+
+    def wait_future(self, conversation: Conversation, future: concurrent.futures.Future) -> None:
+        """Suspend the current conversation until the future is done, even if updates arrive in the meantime."""
+        conversation._future = future
+        try:
+            # The callback runs in the thread completing the future, or right away if it is done already
+            future.add_done_callback(lambda _: self.wake(conversation))
+            while not future.done():
+                self.wait(conversation, None)
+        finally:
+            conversation._future = None
+
+    def finished(self, conversation: Conversation) -> None:
+        with self._lock:
+            self.active -= 1
+
+    def run(self):
+        self._hub = greenlet.getcurrent()
+        while True:
+            try:
+                conversation = self._inbox.get(timeout=self._next_timeout())
+            except queuem.Empty:
+                pass
+            else:
+                if conversation._greenlet is None and conversation._started.is_set():
+                    self._start(conversation)
+                elif conversation._ready():
+                    self._resume(conversation)
+            self._expire_timeouts()
+
+    def _next_timeout(self) -> Optional[float]:
+        if not self._timeouts:
+            return None
+        return max(self._timeouts[0][0] - time.monotonic(), 0)
+
+    def _expire_timeouts(self) -> None:
+        now = time.monotonic()
+        while self._timeouts and self._timeouts[0][0] <= now:
+            _, _, wait_id, conversation = heapq.heappop(self._timeouts)
+            # Ignore the timeouts of waits that have already been resumed
+            if conversation._waiting and conversation._wait_id == wait_id:
+                self._resume(conversation)
+
+    def _start(self, conversation: Conversation) -> None:
+        with self._lock:
+            self.active += 1
+        conversation._greenlet = greenlet.greenlet(conversation._main, parent=self._hub)
+        conversation._greenlet.conversation = conversation
+        self._switch(conversation)
+
+    def _resume(self, conversation: Conversation) -> None:
+        conversation._waiting = False
+        self._switch(conversation)
+
+    def _switch(self, conversation: Conversation) -> None:
+        # Log the conversation messages with the name of the conversation, like they were logged with threads
+        self.name, lane_name = conversation.name, self.name
+        try:
+            conversation._greenlet.switch()
+        finally:
+            self.name = lane_name
+
+
+def current() -> Optional[Conversation]:
+    """Return the conversation running in the current greenlet, or None outside of conversations."""
+    return getattr(greenlet.getcurrent(), "conversation", None)
+
+
+def sleep(seconds: float) -> None:
+    """Pause the current conversation without holding the thread of its lane, like time.sleep outside of them."""
+    conversation = current()
+    if conversation is None:
+        time.sleep(seconds)
+    else:
+        conversation.lane.sleep(conversation, seconds)
+
+
+def result(future: concurrent.futures.Future):
+    """Wait for a future and return its result, without holding the thread of the lane like Future.result would."""
+    conversation = current()
+    if conversation is not None:
+        conversation.lane.wait_future(conversation, future)
+    return future.result()
+
+
+class ConversationPool:
+    """A fixed number of lanes running all the conversations of the bot.
+    Every chat is always assigned to the same lane, so its updates are handled in order."""
+
+    def __init__(self, size: int):
+        self.lanes: List[Lane] = [Lane(index) for index in range(size)]
+        for lane in self.lanes:
+            lane.start()
+
+    def lane_for(self, chat_id: int) -> Lane:
+        return self.lanes[chat_id % len(self.lanes)]
+
+    @property
+    def active(self) -> int:
+        """The number of conversations which have been started and have not ended yet."""
+        return sum(lane.active for lane in self.lanes)
+
+
+class ConversationRegistry:
+    """The live conversations of the bot, indexed by chat id.
+    Conversations are removed as soon as they end, and when there are more than max_size of them the least recently
+    used one is stopped to make room for the new one. Thread-safe."""
+
+    def __init__(self, max_size: int):
+        self.max_size: int = max_size
+        # Ordered from the least to the most recently used
+        self._conversations: "collections.OrderedDict[int, Conversation]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted: int = 0
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    def get(self, chat_id: int) -> Optional[Conversation]:
+        """Get the live conversation of a chat, marking it as the most recently used."""
+        with self._lock:
+            conversation = self._conversations.get(chat_id)
+            if conversation is None:
+                return None
+            if not conversation.is_alive():
+                del self._conversations[chat_id]
+                return None
+            self._conversations.move_to_end(chat_id)
+            return conversation
+
+    def add(self, chat_id: int, conversation: Conversation) -> None:
+        """Register the conversation of a chat, stopping the least recently used ones if the registry is full."""
+        conversation.add_done_callback(lambda: self.discard(chat_id, conversation))
+        evicted = []
+        with self._lock:
+            self._conversations[chat_id] = conversation
+            self._conversations.move_to_end(chat_id)
+            while len(self._conversations) > self.max_size:
+                _, oldest = self._conversations.popitem(last=False)
+                evicted.append(oldest)
+            self.evicted += len(evicted)
+        for oldest in evicted:
+            log.info(f"Too many live conversations, evicting {oldest.name}")
+            oldest.stop("evicted", wait=False)
+
+    def discard(self, chat_id: int, conversation: Conversation) -> None:
+        """Remove a conversation, unless the chat has already started a new one."""
+        with self._lock:
+            if self._conversations.get(chat_id) is conversation:
+                del self._conversations[chat_id]
+
+    def stats(self) -> Dict[str, int]:
+        """Return the figures to monitor the registry."""
+        return {"live": len(self._conversations), "max": self.max_size, "evicted": self.evicted}
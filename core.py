@@ -1,17 +1,18 @@
 import logging
 import os, sys
+import secrets
 import threading
 import multiprocessing as mp
 
-import sqlalchemy
-import sqlalchemy.ext.declarative as sed
 import telegram
 
-import database
+import conversations
+import dbruntime
+import downloader
 import duckbot
+import jobs
 import localization
 import nuconfig
-import worker
 import threading
 
 try:
@@ -30,6 +31,8 @@ from gunicorn.app.base import BaseApplication
 import argparse
 from logger.logger import init
 from server import server
+from werkzeug.serving import make_server
+from dispatcher import Dispatcher
 log = None
 PORT = '8080'
 HOST = '127.0.0.1'
@@ -87,6 +90,8 @@ def flask_api():
             options = {
                 'bind': '0.0.0.0:8080',
                 'workers': 4,
+                # Every request thread gets its own database session
+                'threads': 4,
             }
             StandaloneApplication(server, options).run()
     except KeyboardInterrupt:
@@ -148,24 +153,12 @@ def start_bot():
     # Ignore most python-telegram-bot logs, as they are useless most of the time
     logging.getLogger("telegram").setLevel("ERROR")
 
-    # Find the database URI
-    # Through environment variables first
-    if db_engine := os.environ.get("DB_ENGINE"):
-        log.debug("Sqlalchemy engine overridden by the DB_ENGINE envvar.")
-    # Then via the config file
-    else:
-        db_engine = user_cfg["Database"]["engine"]
-        log.debug("Using sqlalchemy engine set in the configuration file.")
-
-    # Create the database engine
+    # Create the database engine, from the DB_ENGINE environment variable first, then via the config file
     log.debug("Creating the sqlalchemy engine...")
-    engine = sqlalchemy.create_engine(db_engine)
-    log.debug("Binding metadata to the engine...")
-    database.TableDeclarativeBase.metadata.bind = engine
-    log.debug("Creating all missing tables...")
-    database.TableDeclarativeBase.metadata.create_all()
-    log.debug("Preparing the tables through deferred reflection...")
-    sed.DeferredReflection.prepare(engine)
+    db_runtime = dbruntime.Database(user_cfg)
+    engine = db_runtime.engine
+    db_runtime.setup()
+    search_index = db_runtime.search_index
 
     # Create a bot instance
     # Create a bot instance
@@ -185,15 +178,67 @@ def start_bot():
     # Creating localization object
     default_loc = localization.Localization(language=default_language, fallback=default_language)
 
-    # Create a dictionary linking the chat ids to the Worker objects
-    chat_workers = {}
-
-    # Current update offset; if None it will get the last 100 unparsed messages
-    next_update = None
+    # Create the threads running the conversations
+    conversation_pool = conversations.ConversationPool(user_cfg["Telegram"]["conversation_threads"])
+
+    # Create the threads running the background jobs, and the HTTP connection pool they download files with
+    job_runner = jobs.JobRunner(user_cfg["Jobs"]["workers"])
+    # The exports get their own threads, so that they can't hold back the other jobs
+    export_runner = jobs.JobRunner(user_cfg["Jobs"]["export_workers"],
+                                   max_queued=user_cfg["Jobs"]["max_queued_exports"],
+                                   thread_name_prefix="Export")
+    image_downloader = downloader.Downloader.from_config(user_cfg)
+
+    # Check where the updates will be received
+    webhook_secret = None
+    if user_cfg["Telegram"]["mode"] == "webhook":
+        webhook_secret = user_cfg["Telegram"]["webhook_secret"] or secrets.token_urlsafe(32)
+
+    # Create the thread forwarding the updates to the workers
+    dispatcher = Dispatcher(bot=bot,
+                            cfg=user_cfg,
+                            engine=engine,
+                            search_index=search_index,
+                            pool=conversation_pool,
+                            jobs=job_runner,
+                            export_jobs=export_runner,
+                            downloader=image_downloader,
+                            default_loc=default_loc,
+                            webhook_secret=webhook_secret)
+    dispatcher.start()
 
     # Notify on the console that the bot is starting
     log.info(f"@{me.username} is starting!")
 
+    if webhook_secret is not None:
+        receive_webhook_updates(bot, user_cfg, dispatcher)
+    else:
+        poll_updates(bot, user_cfg, dispatcher)
+
+
+def receive_webhook_updates(bot, user_cfg, dispatcher: Dispatcher):
+    """Serve the webhook endpoint of the Flask server, and ask Telegram to send the updates to it."""
+    log = logging.getLogger("core")
+    # The API workers run in other processes, so the bot process serves the webhook on its own port
+    server.extensions["telegram_dispatcher"] = dispatcher
+    webhook_server = make_server(user_cfg["Telegram"]["webhook_host"], user_cfg["Telegram"]["webhook_port"],
+                                 server, threaded=True)
+    webhook_url = f"{user_cfg['Telegram']['webhook_url'].rstrip('/')}/telegram/{dispatcher.webhook_secret}"
+    log.debug("Registering the webhook on Telegram...")
+    bot.set_webhook(url=webhook_url, secret_token=dispatcher.webhook_secret)
+    log.info(f"Receiving updates through the webhook on port {user_cfg['Telegram']['webhook_port']}")
+    webhook_server.serve_forever()
+
+
+def poll_updates(bot, user_cfg, dispatcher: Dispatcher):
+    """Get the updates from Telegram through long polling."""
+    log = logging.getLogger("core")
+    # Telegram refuses to answer getUpdates while a webhook is set
+    bot.delete_webhook()
+
+    # Current update offset; if None it will get the last 100 unparsed messages
+    next_update = None
+
     # Main loop of the program
     while True:
         # Get a new batch of 100 updates and mark the last 100 parsed as read
@@ -201,110 +246,9 @@ def start_bot():
         log.debug(f"Getting updates from Telegram with a timeout of {update_timeout} seconds")
         updates = bot.get_updates(offset=next_update,
                                   timeout=update_timeout)
-        # Parse all the updates
+        # Hand the updates to the dispatcher
         for update in updates:
-            # If the update is a message...
-            if update.message is not None:
-                # Ensure the message has been sent in a private chat
-                if update.message.chat.type != "private":
-                    log.debug(f"Received a message from a non-private chat: {update.message.chat.id}")
-                    # Notify the chat
-                    bot.send_message(update.message.chat.id, default_loc.get("error_nonprivate_chat"))
-                    # Skip the update
-                    continue
-                # If the message is a start command...
-                if isinstance(update.message.text, str) and update.message.text.startswith("/start"):
-                    log.info(f"Received /start from: {update.message.chat.id}")
-                    # Check if a worker already exists for that chat
-                    old_worker = chat_workers.get(update.message.chat.id)
-                    # If it exists, gracefully stop the worker
-                    if old_worker:
-                        log.debug(f"Received request to stop {old_worker.name}")
-                        old_worker.stop("request")
-                    # Initialize a new worker for the chat
-                    new_worker = worker.Worker(bot=bot,
-                                               chat=update.message.chat,
-                                               telegram_user=update.message.from_user,
-                                               cfg=user_cfg,
-                                               engine=engine,
-                                               daemon=True)
-                    # Start the worker
-                    log.debug(f"Starting {new_worker.name}")
-                    new_worker.start()
-                    # Store the worker in the dictionary
-                    chat_workers[update.message.chat.id] = new_worker
-                    # Skip the update
-                    continue
-                # Otherwise, forward the update to the corresponding worker
-                receiving_worker = chat_workers.get(update.message.chat.id)
-                # Ensure a worker exists for the chat and is alive
-                if receiving_worker is None:
-                    log.debug(f"Received a message in a chat without worker: {update.message.chat.id}")
-                    # Suggest that the user restarts the chat with /start
-                    bot.send_message(update.message.chat.id, default_loc.get("error_no_worker_for_chat"),
-                                     reply_markup=telegram.ReplyKeyboardRemove())
-                    # Skip the update
-                    continue
-                # If the worker is not ready...
-                if not receiving_worker.is_ready():
-                    log.debug(f"Received a message in a chat where the worker wasn't ready yet: {update.message.chat.id}")
-                    # Suggest that the user restarts the chat with /start
-                    bot.send_message(update.message.chat.id, default_loc.get("error_worker_not_ready"),
-                                     reply_markup=telegram.ReplyKeyboardRemove())
-                    # Skip the update
-                    continue
-                # If the message contains the "Cancel" string defined in the strings file...
-                if update.message.text == receiving_worker.loc.get("menu_cancel"):
-                    log.debug(f"Forwarding CancelSignal to {receiving_worker}")
-                    # Send a CancelSignal to the worker instead of the update
-                    receiving_worker.queue.put(worker.CancelSignal())
-                else:
-                    log.debug(f"Forwarding message to {receiving_worker}")
-                    # Forward the update to the worker
-                    receiving_worker.queue.put(update)
-            # If the update is a inline keyboard press...
-            if isinstance(update.callback_query, telegram.CallbackQuery):
-                # Forward the update to the corresponding worker
-                receiving_worker = chat_workers.get(update.callback_query.from_user.id)
-                # Ensure a worker exists for the chat
-                if receiving_worker is None:
-                    log.debug(
-                        f"Received a callback query in a chat without worker: {update.callback_query.from_user.id}")
-                    # Suggest that the user restarts the chat with /start
-                    bot.send_message(update.callback_query.from_user.id, default_loc.get("error_no_worker_for_chat"))
-                    # Skip the update
-                    continue
-                # Check if the pressed inline key is a cancel button
-                if update.callback_query.data == "cmd_cancel":
-                    log.debug(f"Forwarding CancelSignal to {receiving_worker}")
-                    # Forward a CancelSignal to the worker
-                    receiving_worker.queue.put(worker.CancelSignal())
-                    # Notify the Telegram client that the inline keyboard press has been received
-                    bot.answer_callback_query(update.callback_query.id)
-                else:
-                    log.debug(f"Forwarding callback query to {receiving_worker}")
-                    # Forward the update to the worker
-                    receiving_worker.queue.put(update)
-            # If the update is a precheckoutquery, ensure it hasn't expired before forwarding it
-            if isinstance(update.pre_checkout_query, telegram.PreCheckoutQuery):
-                # Forward the update to the corresponding worker
-                receiving_worker = chat_workers.get(update.pre_checkout_query.from_user.id)
-                # Check if it's the active invoice for this chat
-                if receiving_worker is None or \
-                        update.pre_checkout_query.invoice_payload != receiving_worker.invoice_payload:
-                    # Notify the user that the invoice has expired
-                    log.debug(f"Received a pre-checkout query for an expired invoice in: {update.pre_checkout_query.from_user.id}")
-                    try:
-                        bot.answer_pre_checkout_query(update.pre_checkout_query.id,
-                                                      ok=False,
-                                                      error_message=default_loc.get("error_invoice_expired"))
-                    except telegram.error.BadRequest:
-                        log.error("pre-checkout query expired before an answer could be sent!")
-                    # Go to the next update
-                    continue
-                log.debug(f"Forwarding pre-checkout query to {receiving_worker}")
-                # Forward the update to the worker
-                receiving_worker.queue.put(update)
+            dispatcher.queue.put(update)
         # If there were any updates...
         if len(updates):
             # Mark them as read by increasing the update_offset
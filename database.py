@@ -1,16 +1,21 @@
 import logging
 import typing
 
-import requests
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
 import telegram
-from sqlalchemy import Column, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, ForeignKey, Index, UniqueConstraint
 from sqlalchemy import Integer, BigInteger, String, Text, LargeBinary, DateTime, Boolean, Float
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, deferred
 
 import utils
 
 if typing.TYPE_CHECKING:
+    import blobstore
+    import downloader as downloaderm
+    import imaging
     import worker
 
 log = logging.getLogger(__name__)
@@ -108,6 +113,8 @@ class Product(TableDeclarativeBase):
 
     # Extra table parameters
     __tablename__ = "products"
+    # Product lists filter out the deleted products, the admin menus also look them up by name
+    __table_args__ = (Index("ix_products_deleted_name", "deleted", "name"),)
 
     # No __init__ is needed, the default one is sufficient
 
@@ -132,15 +139,17 @@ class Product(TableDeclarativeBase):
 
     def send_as_message(self, w: "worker.Worker", chat_id: int) -> dict:
         """发送包含产品数据的消息。"""
-        if self.images.count() > 0:
-            msg = w.bot.send_photo(chat_id, self.images[0].data, caption=self.text(w))
+        image = self.images.order_by(ProductImage.id).first()
+        if image is not None:
+            msg = image.send_photo(w, chat_id, caption=self.text(w))
         else:
             msg = w.bot.send_message(chat_id, self.text(w))
         return msg.to_dict()
 
-    def set_image(self, file: telegram.File):
-        """从Telegram下载图像并将其存储在product_images表中。"""
-        image = ProductImage.from_file(self.id, file)
+    def set_image(self, file: telegram.File, store: "blobstore.BlobStore", variant_maker: "imaging.VariantMaker",
+                  downloader: "downloaderm.Downloader"):
+        """从Telegram下载图像并将其存入图片存储。"""
+        image = ProductImage.from_file(self.id, file, store, variant_maker, downloader)
         self.images.append(image)
 
 
@@ -149,10 +158,20 @@ class ProductImage(TableDeclarativeBase):
 
     # 产品图片id
     id = Column(Integer, primary_key=True)
-    # 产品id
-    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
-    # 图像数据
-    data = Column(LargeBinary)
+    # 产品id，商品详情按它查询图片
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False, index=True)
+    # 旧的图像数据，迁移到图片存储后为空，只在用到时加载
+    data = deferred(Column(LargeBinary))
+    # 图片内容的sha256，即它在图片存储中的key
+    sha256 = Column(String(64), index=True)
+    # 图片尺寸
+    width = Column(Integer)
+    height = Column(Integer)
+    # Telegram保存的图片file_id，再次发送时不用重新上传
+    telegram_file_id = Column(String)
+
+    # 缩小后的图片
+    variants = relationship("ProductImageVariant", backref="image", lazy="dynamic")
 
     # 表格参数
     __tablename__ = "product_images"
@@ -163,18 +182,129 @@ class ProductImage(TableDeclarativeBase):
         return f"<ProductImage {self.id}>"
 
     @classmethod
-    def from_file(cls, product_id: int, file: telegram.File) -> "ProductImage":
+    def from_file(cls, product_id: int, file: telegram.File, store: "blobstore.BlobStore",
+                  variant_maker: "imaging.VariantMaker", downloader: "downloaderm.Downloader") -> "ProductImage":
         """从Telegram文件创建一个新的ProductImage实例。"""
-        # 通过get请求下载照片
-        r = requests.get(file.file_path)
-        # 使用下载的数据创建一个新的ProductImage实例
-        return cls(product_id=product_id, data=r.content)
+        # 下载照片，有超时、重试和大小限制
+        data = downloader.get(file.file_path)
+        # 使用下载的数据创建一个新的ProductImage实例，文件已经在Telegram上，直接记下它的file_id
+        image = cls.from_data(product_id, data, store, variant_maker)
+        image.telegram_file_id = file.file_id
+        return image
+
+    @classmethod
+    def from_data(cls, product_id: int, data: bytes, store: "blobstore.BlobStore",
+                  variant_maker: "imaging.VariantMaker") -> "ProductImage":
+        """把图片数据存入图片存储，相同的图片只保存一份。"""
+        image = cls(product_id=product_id)
+        image.store_data(data, store, variant_maker)
+        return image
+
+    def store_data(self, data: bytes, store: "blobstore.BlobStore",
+                   variant_maker: typing.Optional["imaging.VariantMaker"] = None) -> None:
+        """把图片数据存入图片存储，表中只记录sha256和尺寸，并生成缩小后的图片。"""
+        self.sha256 = store.put(data)
+        self.width, self.height = utils.image_size(data) or (None, None)
+        self.data = None
+        if variant_maker is not None:
+            self.add_variants(data, store, variant_maker)
+
+    def add_variants(self, data: bytes, store: "blobstore.BlobStore", variant_maker: "imaging.VariantMaker") -> None:
+        """生成缩小后的图片，存入图片存储。比原图大的尺寸不生成，直接使用原图。"""
+        for variant in variant_maker.make(data):
+            self.variants.append(ProductImageVariant(size=variant.size,
+                                                     sha256=store.put(variant.data),
+                                                     width=variant.width,
+                                                     height=variant.height))
+
+    def read(self, store: "blobstore.BlobStore") -> bytes:
+        """读取图片数据，还没有迁移的图片从表中读取。"""
+        if self.sha256 is not None:
+            return store.get(self.sha256)
+        return self.data
+
+    def send_photo(self, w: "worker.Worker", chat_id: int, **kwargs) -> telegram.Message:
+        """发送图片，优先使用缓存的file_id，Telegram不接受时重新上传并缓存新的file_id。"""
+        if self.telegram_file_id is not None:
+            try:
+                return w.bot.send_photo(chat_id, self.telegram_file_id, **kwargs)
+            except telegram.error.BadRequest as e:
+                log.warning(f"Telegram rejected the file_id of {self}, uploading it again: {e}")
+        msg = w.bot.send_photo(chat_id, self.read(w.blob_store), **kwargs)
+        if msg is not None and msg.photo:
+            self.save_file_id(msg.photo[-1].file_id)
+        return msg
+
+    def save_file_id(self, file_id: str) -> None:
+        """在单独的连接中保存file_id，不影响会话中正在进行的事务。"""
+        try:
+            with sqlalchemy.orm.object_session(self).get_bind().begin() as connection:
+                connection.execute(ProductImage.__table__.update()
+                                   .where(ProductImage.id == self.id)
+                                   .values(telegram_file_id=file_id))
+        except sqlalchemy.exc.OperationalError as e:
+            # 下次发送时再试
+            log.warning(f"Could not save the file_id of {self}: {e}")
+            return
+        sqlalchemy.orm.attributes.set_committed_value(self, "telegram_file_id", file_id)
+
+class ProductImageVariant(TableDeclarativeBase):
+    """商品图片缩小后的版本，商品列表使用它们代替原图。"""
+
+    # 缩小后的图片id
+    id = Column(Integer, primary_key=True)
+    # 原图id
+    image_id = Column(Integer, ForeignKey("product_images.id"), nullable=False)
+    # 尺寸名称，见imaging.SIZES
+    size = Column(String(16), nullable=False)
+    # 图片内容的sha256，即它在图片存储中的key
+    sha256 = Column(String(64), nullable=False)
+    # 图片尺寸
+    width = Column(Integer)
+    height = Column(Integer)
+
+    # 表格参数
+    __tablename__ = "product_image_variants"
+    __table_args__ = (UniqueConstraint("image_id", "size"),)
+
+    def __repr__(self):
+        return f"<ProductImageVariant {self.size} of {self.image_id}>"
+
+
+class CatalogueGeneration(TableDeclarativeBase):
+    """A counter increased every time the products change.
+    The API processes compare it with the one of their cached catalogue to know when to reload it."""
+
+    # There is a single row, with id 1
+    id = Column(Integer, primary_key=True)
+    # The current generation of the catalogue
+    generation = Column(Integer, nullable=False, default=0)
+
+    # Extra table parameters
+    __tablename__ = "catalogue_generation"
+
+    def __repr__(self):
+        return f"<CatalogueGeneration {self.generation}>"
+
+    @classmethod
+    def current(cls, session) -> int:
+        """Get the current generation of the catalogue."""
+        return session.query(cls.generation).filter_by(id=1).scalar() or 0
+
+    @classmethod
+    def bump(cls, session) -> None:
+        """Increase the generation as part of the current transaction, invalidating all the cached catalogues."""
+        if not session.query(cls).filter_by(id=1).update({cls.generation: cls.generation + 1}):
+            session.add(cls(id=1, generation=1))
+
 
 class Cart(TableDeclarativeBase):
     '''
         购物车
     '''
     __tablename__ = 'cart'
+    # 按用户和商品查询购物车
+    __table_args__ = (Index("ix_cart_user_product", "user_id", "product_id"),)
 
     id = Column(Integer, primary_key=True)
     user_id = Column(String(50), nullable=False)
@@ -213,7 +343,7 @@ class Transaction(TableDeclarativeBase):
     payment_email = Column(String)
 
     # Order ID
-    order_id = Column(Integer, ForeignKey("orders.order_id"))
+    order_id = Column(Integer, ForeignKey("orders.order_id"), index=True)
     order = relationship("Order", back_populates="transaction")
 
     # Extra table parameters
@@ -253,7 +383,7 @@ class Admin(TableDeclarativeBase):
     display_on_help = Column(Boolean, default=False)
     is_owner = Column(Boolean, default=False)
     # Live mode enabled
-    live_mode = Column(Boolean, default=False)
+    live_mode = Column(Boolean, default=False, index=True)
 
     # Extra table parameters
     __tablename__ = "admins"
@@ -269,7 +399,7 @@ class Order(TableDeclarativeBase):
     # The unique order id
     order_id = Column(Integer, primary_key=True)
     # The user who placed the order
-    user_id = Column(BigInteger, ForeignKey("users.user_id"))
+    user_id = Column(BigInteger, ForeignKey("users.user_id"), index=True)
     user = relationship("User", lazy='joined')
     # Date of creation
     creation_date = Column(DateTime, nullable=False)
@@ -292,6 +422,8 @@ class Order(TableDeclarativeBase):
 
     # Extra table parameters
     __tablename__ = "orders"
+    # The orders menu lists the orders which have been neither delivered nor refunded
+    __table_args__ = (Index("ix_orders_pending", "delivery_date", "refund_date"),)
 
     def __repr__(self):
         return f"<Order {self.order_id} placed by User {self.user_id}>"
@@ -338,14 +470,40 @@ class OrderItem(TableDeclarativeBase):
     product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
     product = relationship("Product", lazy='joined')
     # The order in which this item is being purchased
-    order_id = Column(Integer, ForeignKey("orders.order_id"), nullable=False)
+    order_id = Column(Integer, ForeignKey("orders.order_id"), nullable=False, index=True)
     order = relationship("Order", back_populates="items", lazy='joined')
+    # How many units of the product are ordered
+    quantity = Column(Integer, nullable=False, default=1, server_default=sqlalchemy.text("1"))
 
     # Extra table parameters
     __tablename__ = "orderitems"
 
     def text(self, w: "worker.Worker"):
-        return f"{self.product.name} - {str(w.Price(self.product.price))} \n快递单号：{self.order.tracking_number if self.order.tracking_number else '暂无'}\n"
+        return f"{self.product.name} x {self.quantity} - {str(w.Price(self.product.price * self.quantity))} \n快递单号：{self.order.tracking_number if self.order.tracking_number else '暂无'}\n"
 
     def __repr__(self):
         return f"<OrderItem {self.item_id}>"
+
+
+
+class IdempotencyKey(TableDeclarativeBase):
+    """The response to an API request sent with an Idempotency-Key header, replayed if the request is sent again."""
+
+    # SHA-256 of the endpoint and of the key sent by the client
+    key = Column(String(64), primary_key=True)
+    # SHA-256 of the request body, as the key can't be reused for another request
+    request_hash = Column(String(64), nullable=False)
+    # Random token of the request handling the key, so that it never overwrites the claim of another one
+    token = Column(String(32))
+    # Status of the response: if null, the request is still being handled
+    status_code = Column(Integer)
+    # Body of the response
+    response = Column(LargeBinary)
+    # When the response is forgotten, or the request is considered abandoned, and the key can be used again
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    # Extra table parameters
+    __tablename__ = "idempotency_keys"
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key}>"
@@ -0,0 +1,163 @@
+import logging
+import os
+import threading
+from typing import *
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.ext.declarative
+import sqlalchemy.orm
+import sqlalchemy.pool
+from sqlalchemy.engine.url import make_url
+
+import database as db
+import migrations
+import nuconfig
+import search
+
+log = logging.getLogger(__name__)
+
+# Values accepted by the pragmas which take a name
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SYNCHRONOUS_LEVELS = ("off", "normal", "full", "extra")
+
+
+def database_url(cfg: nuconfig.NuConfig) -> str:
+    """Return the url of the database, from the DB_ENGINE environment variable or from the config file."""
+    if db_engine := os.environ.get("DB_ENGINE"):
+        log.debug("Sqlalchemy engine overridden by the DB_ENGINE envvar.")
+        return db_engine
+    log.debug("Using sqlalchemy engine set in the configuration file.")
+    return cfg["Database"]["engine"]
+
+
+def is_sqlite_file(db_engine: str) -> bool:
+    url = make_url(db_engine)
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+
+def engine_options(db_engine: str, db_cfg: dict) -> dict:
+    """Build the create_engine keyword arguments for the pool settings of the [Database] section."""
+    options = {
+        "pool_recycle": db_cfg["pool_recycle"],
+        "pool_pre_ping": db_cfg["pool_pre_ping"],
+    }
+    if is_sqlite_file(db_engine):
+        # Keep pool_size connections open, so that their page cache and memory map are reused by the next requests,
+        # but never make anyone wait for a connection, like the NullPool SQLite used before
+        options["poolclass"] = sqlalchemy.pool.QueuePool
+        options["pool_size"] = db_cfg["pool_size"]
+        options["max_overflow"] = -1
+        # Pooled connections are handed to other threads, which SQLite allows when built thread-safe
+        options["connect_args"] = {"check_same_thread": False}
+    elif make_url(db_engine).get_backend_name() != "sqlite":
+        options["pool_size"] = db_cfg["pool_size"]
+        options["max_overflow"] = db_cfg["max_overflow"]
+    return options
+
+
+def sqlite_pragmas(sqlite_cfg: dict) -> List[str]:
+    """Build the PRAGMA statements of the [Database.SQLite] section, which are run on every new connection."""
+    journal_mode = sqlite_cfg["journal_mode"].lower()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"Unknown SQLite journal_mode: {journal_mode}")
+    synchronous = sqlite_cfg["synchronous"].lower()
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f"Unknown SQLite synchronous level: {synchronous}")
+    return [
+        f"PRAGMA journal_mode={journal_mode}",
+        f"PRAGMA synchronous={synchronous}",
+        f"PRAGMA busy_timeout={int(sqlite_cfg['busy_timeout'])}",
+        f"PRAGMA mmap_size={int(sqlite_cfg['mmap_size'])}",
+        f"PRAGMA cache_size={int(sqlite_cfg['cache_size'])}",
+    ]
+
+
+def guard_fork(engine) -> None:
+    """Never hand out a pooled connection opened by another process.
+    A forked process inherits the pool of its parent, whose sockets and file handles are still used by the parent:
+    they are dropped without being closed, and replaced by new connections."""
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def remember_pid(dbapi_connection, connection_record):
+        connection_record.info["pid"] = os.getpid()
+
+    @sqlalchemy.event.listens_for(engine, "checkout")
+    def check_pid(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info["pid"] != os.getpid():
+            # Closing the connection would close it for the parent too
+            connection_record.connection = connection_proxy.connection = None
+            raise sqlalchemy.exc.DisconnectionError("Connection opened by another process")
+
+
+def create_engine(db_engine: str, db_cfg: dict):
+    """Create the engine of the database, with the pool and, on SQLite, the connection settings of the config.
+    The bot, the API processes and the tools should all get their engine from here."""
+    engine = sqlalchemy.create_engine(db_engine, **engine_options(db_engine, db_cfg))
+    guard_fork(engine)
+    if make_url(db_engine).get_backend_name() == "sqlite":
+        pragmas = sqlite_pragmas(db_cfg["SQLite"])
+
+        @sqlalchemy.event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                for pragma in pragmas:
+                    cursor.execute(pragma)
+            finally:
+                cursor.close()
+
+    return engine
+
+
+class Database:
+    """The database of a process: the engine, created on first use in every process, and its sessions.
+    Creating it opens no connection, so it can be done at import time by modules loaded before gunicorn forks."""
+
+    def __init__(self, cfg: nuconfig.NuConfig, db_engine: Optional[str] = None):
+        self.cfg: nuconfig.NuConfig = cfg
+        self.url: str = db_engine or database_url(cfg)
+        self.sessions = sqlalchemy.orm.sessionmaker()
+        self._engine = None
+        self._pid: Optional[int] = None
+        # Engines created by the parent processes, kept so that their connections are never closed by this one
+        self._inherited: list = []
+        self._search_index: Optional[search.SearchIndex] = None
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if self._engine is not None:
+                        log.debug(f"Creating a new engine in the forked process {os.getpid()}")
+                        self._inherited.append(self._engine)
+                    self._engine = create_engine(self.url, self.cfg["Database"])
+                    self.sessions.configure(bind=self._engine)
+                    self._pid = os.getpid()
+        return self._engine
+
+    def session(self) -> sqlalchemy.orm.Session:
+        """Open a new session on the engine of this process."""
+        self.engine
+        return self.sessions()
+
+    @property
+    def search_index(self) -> search.SearchIndex:
+        """The product search supported by the database, detected on first use."""
+        if self._search_index is None:
+            self._search_index = search.for_engine(self.engine)
+        return self._search_index
+
+    def setup(self) -> None:
+        """Bring the schema up to date and prepare the search index. Run by the bot when it starts."""
+        engine = self.engine
+        log.debug("Binding metadata to the engine...")
+        db.TableDeclarativeBase.metadata.bind = engine
+        log.debug("Creating the missing tables and applying the schema migrations...")
+        migrations.upgrade(engine)
+        log.debug("Preparing the tables through deferred reflection...")
+        sqlalchemy.ext.declarative.DeferredReflection.prepare(engine)
+        log.debug("Preparing the product search index...")
+        self.search_index.setup(engine)
@@ -0,0 +1,187 @@
+import concurrent.futures
+import hmac
+import logging
+import queue as queuem
+import threading
+from typing import *
+
+import telegram
+
+import conversations
+import jobs as jobsm
+import localization
+import nuconfig
+import search
+import worker
+from downloader import Downloader
+
+log = logging.getLogger(__name__)
+
+
+class Dispatcher(threading.Thread):
+    """Routes the updates received from Telegram to the conversations of their chats.
+    Updates are put in the queue by the long polling loop or by the webhook endpoint, and are dispatched in order by
+    this thread, so receiving new updates never waits for the handling of the previous ones."""
+
+    def __init__(self, bot, cfg: nuconfig.NuConfig, engine, search_index: search.SearchIndex,
+                 pool: conversations.ConversationPool, jobs: jobsm.JobRunner, export_jobs: jobsm.JobRunner,
+                 downloader: Downloader, default_loc: localization.Localization,
+                 webhook_secret: Optional[str] = None):
+        super().__init__(name="Dispatcher", daemon=True)
+        self.bot = bot
+        self.cfg = cfg
+        self.engine = engine
+        self.search_index: search.SearchIndex = search_index
+        self.pool: conversations.ConversationPool = pool
+        self.jobs: jobsm.JobRunner = jobs
+        self.export_jobs: jobsm.JobRunner = export_jobs
+        self.downloader: Downloader = downloader
+        self.default_loc: localization.Localization = default_loc
+        self.webhook_secret: Optional[str] = webhook_secret
+        # The updates waiting to be dispatched
+        self.queue: queuem.Queue = queuem.Queue()
+        # The registry linking the chat ids to the live Worker objects
+        self.chat_workers = conversations.ConversationRegistry(cfg["Telegram"]["max_conversations"])
+        # The replies sent by the dispatcher itself, so that a slow request doesn't hold back the other chats
+        self.replies = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="Reply")
+
+    def check_secret(self, secret: str, header: Optional[str]) -> bool:
+        """Check the secret in the url and in the X-Telegram-Bot-Api-Secret-Token header of a webhook request."""
+        if not self.webhook_secret:
+            return False
+        return hmac.compare_digest(secret, self.webhook_secret) and \
+            hmac.compare_digest(header or "", self.webhook_secret)
+
+    def put_json(self, data: dict) -> None:
+        """Queue an update received as JSON by the webhook."""
+        self.queue.put(telegram.Update.de_json(data, self.bot.bot))
+
+    def run(self):
+        while True:
+            update = self.queue.get()
+            try:
+                self.dispatch(update)
+            except Exception as e:
+                log.error(f"Could not dispatch update {update.update_id}: {e}", exc_info=True)
+
+    def _reply(self, method: Callable, *args, **kwargs) -> None:
+        self.replies.submit(method, *args, **kwargs)
+
+    def dispatch(self, update: telegram.Update) -> None:
+        """Handle an update, forwarding it to the worker of its chat."""
+        # If the update is a message...
+        if update.message is not None:
+            # Ensure the message has been sent in a private chat
+            if update.message.chat.type != "private":
+                log.debug(f"Received a message from a non-private chat: {update.message.chat.id}")
+                # Notify the chat
+                self._reply(self.bot.send_message, update.message.chat.id,
+                            self.default_loc.get("error_nonprivate_chat"))
+                # Skip the update
+                return
+            # If the message is a start command...
+            if isinstance(update.message.text, str) and update.message.text.startswith("/start"):
+                log.info(f"Received /start from: {update.message.chat.id}")
+                # Check if a worker already exists for that chat
+                old_worker = self.chat_workers.get(update.message.chat.id)
+                # If it exists, ask the worker to stop gracefully
+                if old_worker:
+                    log.debug(f"Received request to stop {old_worker.name}")
+                    # Don't wait for it: it may be sleeping through a Telegram backoff, which would hold back the
+                    # updates of every chat. The registry drops it when it ends, unless the chat has a new one.
+                    old_worker.stop("request", wait=False)
+                # Initialize a new worker for the chat
+                new_worker = worker.Worker(bot=self.bot,
+                                           chat=update.message.chat,
+                                           telegram_user=update.message.from_user,
+                                           cfg=self.cfg,
+                                           engine=self.engine,
+                                           search_index=self.search_index,
+                                           pool=self.pool,
+                                           jobs=self.jobs,
+                                           export_jobs=self.export_jobs,
+                                           downloader=self.downloader)
+                # Start the worker
+                log.debug(f"Starting {new_worker.name}")
+                new_worker.start()
+                # Store the worker in the registry, evicting the least recently used one if it is full
+                self.chat_workers.add(update.message.chat.id, new_worker)
+                log.debug(f"{len(self.chat_workers)} live conversations")
+                # Skip the update
+                return
+            # Otherwise, forward the update to the corresponding worker
+            receiving_worker = self.chat_workers.get(update.message.chat.id)
+            # Ensure a worker exists for the chat and is alive
+            if receiving_worker is None:
+                log.debug(f"Received a message in a chat without worker: {update.message.chat.id}")
+                # Suggest that the user restarts the chat with /start
+                self._reply(self.bot.send_message, update.message.chat.id,
+                            self.default_loc.get("error_no_worker_for_chat"),
+                            reply_markup=telegram.ReplyKeyboardRemove())
+                # Skip the update
+                return
+            # If the worker is not ready...
+            if not receiving_worker.is_ready():
+                log.debug(f"Received a message in a chat where the worker wasn't ready yet: {update.message.chat.id}")
+                # Suggest that the user restarts the chat with /start
+                self._reply(self.bot.send_message, update.message.chat.id,
+                            self.default_loc.get("error_worker_not_ready"),
+                            reply_markup=telegram.ReplyKeyboardRemove())
+                # Skip the update
+                return
+            # If the message contains the "Cancel" string defined in the strings file...
+            if update.message.text == receiving_worker.loc.get("menu_cancel"):
+                log.debug(f"Forwarding CancelSignal to {receiving_worker}")
+                # Send a CancelSignal to the worker instead of the update
+                receiving_worker.queue.put(worker.CancelSignal())
+            else:
+                log.debug(f"Forwarding message to {receiving_worker}")
+                # Forward the update to the worker
+                receiving_worker.queue.put(update)
+        # If the update is a inline keyboard press...
+        if isinstance(update.callback_query, telegram.CallbackQuery):
+            # Forward the update to the corresponding worker
+            receiving_worker = self.chat_workers.get(update.callback_query.from_user.id)
+            # Ensure a worker exists for the chat
+            if receiving_worker is None:
+                log.debug(f"Received a callback query in a chat without worker: {update.callback_query.from_user.id}")
+                # Suggest that the user restarts the chat with /start
+                self._reply(self.bot.send_message, update.callback_query.from_user.id,
+                            self.default_loc.get("error_no_worker_for_chat"))
+                # Skip the update
+                return
+            # Check if the pressed inline key is a cancel button
+            if update.callback_query.data == "cmd_cancel":
+                log.debug(f"Forwarding CancelSignal to {receiving_worker}")
+                # Forward a CancelSignal to the worker
+                receiving_worker.queue.put(worker.CancelSignal())
+                # Notify the Telegram client that the inline keyboard press has been received
+                self._reply(self.bot.answer_callback_query, update.callback_query.id)
+            else:
+                log.debug(f"Forwarding callback query to {receiving_worker}")
+                # Forward the update to the worker
+                receiving_worker.queue.put(update)
+        # If the update is a precheckoutquery, ensure it hasn't expired before forwarding it
+        if isinstance(update.pre_checkout_query, telegram.PreCheckoutQuery):
+            # Forward the update to the corresponding worker
+            receiving_worker = self.chat_workers.get(update.pre_checkout_query.from_user.id)
+            # Check if it's the active invoice for this chat
+            if receiving_worker is None or \
+                    update.pre_checkout_query.invoice_payload != receiving_worker.invoice_payload:
+                # Notify the user that the invoice has expired
+                log.debug(f"Received a pre-checkout query for an expired invoice in: "
+                          f"{update.pre_checkout_query.from_user.id}")
+                self._reply(self._answer_expired_invoice, update.pre_checkout_query.id)
+                # Go to the next update
+                return
+            log.debug(f"Forwarding pre-checkout query to {receiving_worker}")
+            # Forward the update to the worker
+            receiving_worker.queue.put(update)
+
+    def _answer_expired_invoice(self, pre_checkout_query_id: str) -> None:
+        try:
+            self.bot.answer_pre_checkout_query(pre_checkout_query_id,
+                                               ok=False,
+                                               error_message=self.default_loc.get("error_invoice_expired"))
+        except telegram.error.BadRequest:
+            log.error("pre-checkout query expired before an answer could be sent!")
@@ -0,0 +1,63 @@
+import logging
+from typing import *
+
+import requests
+import requests.adapters
+from urllib3.util.retry import Retry
+
+import nuconfig
+
+log = logging.getLogger(__name__)
+
+
+class DownloadError(Exception):
+    """The file could not be downloaded."""
+
+
+class DownloadTooLarge(DownloadError):
+    """The file is bigger than the size limit of the downloader."""
+
+
+class Downloader:
+    """Downloads files through a pool of kept-alive connections, with timeouts, retries and a size limit.
+    Thread-safe."""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, timeout: float, retries: int, max_size: int, pool_size: int = 4):
+        self.timeout: float = timeout
+        self.max_size: int = max_size
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size,
+                                                max_retries=Retry(total=retries,
+                                                                  backoff_factor=0.5,
+                                                                  status_forcelist=(429, 500, 502, 503, 504),
+                                                                  allowed_methods=("GET",)))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_config(cls, cfg: nuconfig.NuConfig) -> "Downloader":
+        images_cfg = cfg["Images"]
+        return cls(timeout=images_cfg["download_timeout"],
+                   retries=images_cfg["download_retries"],
+                   max_size=images_cfg["max_download_size"])
+
+    def get(self, url: str) -> bytes:
+        """Download a file, raising DownloadError if it fails."""
+        try:
+            with self.session.get(url, timeout=self.timeout, stream=True) as response:
+                response.raise_for_status()
+                length = response.headers.get("Content-Length")
+                if length is not None and int(length) > self.max_size:
+                    raise DownloadTooLarge(f"the file is {length} bytes, the limit is {self.max_size}")
+                chunks: List[bytes] = []
+                size = 0
+                for chunk in response.iter_content(self.CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_size:
+                        raise DownloadTooLarge(f"the file is more than {self.max_size} bytes")
+                    chunks.append(chunk)
+                return b"".join(chunks)
+        except requests.RequestException as e:
+            raise DownloadError(str(e)) from e
@@ -1,125 +1,289 @@
+import collections
 import logging
+import random
 import sys, time
+import threading
 import traceback
+from typing import *
 
 import telegram.error
 
+import conversations
 import nuconfig
+import outbound
 
 log = logging.getLogger(__name__)
 
 
+class CircuitOpenError(telegram.error.NetworkError):
+    """Raised instead of calling Telegram while it has been unreachable for a while."""
+
+
+class RetryPolicy:
+    """How a failed request is retried: exponential backoff with jitter, within a number of attempts and a deadline.
+    A limit of 0 means no limit."""
+
+    def __init__(self, max_attempts: int, deadline: float, base_delay: float, max_delay: float):
+        self.max_attempts: int = max_attempts
+        self.deadline: float = deadline
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+
+    @classmethod
+    def from_cfg(cls, policy_cfg: dict) -> "RetryPolicy":
+        return cls(max_attempts=policy_cfg["max_attempts"],
+                   deadline=policy_cfg["deadline"],
+                   base_delay=policy_cfg["base_delay"],
+                   max_delay=policy_cfg["max_delay"])
+
+    def backoff(self, attempt: int) -> float:
+        """The pause after the given failed attempt, counting from 1."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        # Randomize the pause, so that the requests which failed together are not retried together
+        return random.uniform(delay / 2, delay)
+
+    def allows(self, attempt: int, elapsed: float, pause: float) -> bool:
+        """Check if another attempt can be made after a pause."""
+        if self.max_attempts and attempt >= self.max_attempts:
+            return False
+        if self.deadline and elapsed + pause > self.deadline:
+            return False
+        return True
+
+
+class CircuitBreaker:
+    """Stops calling Telegram for a while after too many consecutive network errors."""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold: int = threshold
+        self.cooldown: float = cooldown
+        self.failures: int = 0
+        self.opened_at: Optional[float] = None
+        self.opened: int = 0
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        """The seconds before Telegram can be called again, 0 if the circuit is closed."""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def check(self) -> None:
+        # Once the cooldown has passed the requests are let through, and the first failure opens the circuit again
+        if self.remaining() > 0:
+            raise CircuitOpenError("Telegram is unreachable, not sending the request")
+
+    def success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                log.info("Telegram is reachable again")
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    log.error(f"{self.failures} consecutive network errors, "
+                              f"pausing the requests to Telegram for {self.cooldown} secs")
+                    self.opened += 1
+                self.opened_at = time.monotonic()
+
+
+class Retrier:
+    """The retry policies of the Bot API methods, with the counters of their retries and give-ups."""
+
+    def __init__(self, retry_cfg: dict):
+        self.default_policy: RetryPolicy = RetryPolicy.from_cfg(retry_cfg)
+        self.policies: Dict[str, RetryPolicy] = {method: RetryPolicy.from_cfg({**retry_cfg, **overrides})
+                                                 for method, overrides in retry_cfg["Methods"].items()}
+        self.breaker = CircuitBreaker(retry_cfg["circuit_threshold"], retry_cfg["circuit_cooldown"])
+        self.retries: Counter[str] = collections.Counter()
+        self.give_ups: Counter[str] = collections.Counter()
+        self._lock = threading.Lock()
+
+    def policy(self, method: str) -> RetryPolicy:
+        return self.policies.get(method, self.default_policy)
+
+    def pause(self, method: str, policy: RetryPolicy, attempt: int, start: float, error: Exception,
+              pause: float) -> float:
+        """Return the pause before retrying a failed request, or raise its error if the policy doesn't allow it."""
+        if not policy.allows(attempt, time.monotonic() - start, pause):
+            with self._lock:
+                self.give_ups[method] += 1
+            log.error(f"Giving up calling {method}() after {attempt} attempts")
+            raise error
+        with self._lock:
+            self.retries[method] += 1
+        return pause
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the figures to monitor the failed requests."""
+        with self._lock:
+            return {
+                "retries": dict(self.retries),
+                "give_ups": dict(self.give_ups),
+                "circuit_open": self.breaker.remaining() > 0,
+                "circuit_opened": self.breaker.opened,
+            }
+
+
+def chat_id_of(args: tuple, kwargs: dict, position: int = 0):
+    """Find the chat_id argument of a Bot API call, passed by keyword or at the given position."""
+    if "chat_id" in kwargs:
+        return kwargs["chat_id"]
+    if len(args) > position:
+        return args[position]
+    return None
+
+
 def factory(cfg: nuconfig.NuConfig):
     """Construct a DuckBot type based on the passed config."""
 
+    retrier = Retrier(cfg["Telegram"]["Retry"])
+
     def catch_telegram_errors(func):
-        """Decorator, can be applied to any function to retry in case of Telegram errors."""
+        """Decorator, can be applied to any function to retry in case of Telegram errors.
+        Waiting conversations are suspended instead of blocking the thread of their lane."""
 
         def result_func(*args, **kwargs):
+            method = func.__name__
+            policy = retrier.policy(method)
+            start = time.monotonic()
+            attempt = 0
             while True:
+                attempt += 1
                 try:
-                    return func(*args, **kwargs)
+                    retrier.breaker.check()
+                    result = func(*args, **kwargs)
                 # Bot was blocked by the user
                 except telegram.error.Unauthorized:
-                    log.debug(f"Unauthorized to call {func.__name__}(), skipping.")
+                    retrier.breaker.success()
+                    log.debug(f"Unauthorized to call {method}(), skipping.")
                     return None
+                # The request is invalid, sending it again would fail in the same way
+                except telegram.error.BadRequest:
+                    retrier.breaker.success()
+                    raise
+                # Telegram asked to slow down
+                except telegram.error.RetryAfter as error:
+                    pause = retrier.pause(method, policy, attempt, start, error, error.retry_after)
+                    log.warning(f"Flood limit reached while calling {method}(), retrying in {pause:.1f} secs...")
+                # Telegram has been unreachable for a while, wait for the end of the cooldown
+                except CircuitOpenError as error:
+                    pause = retrier.pause(method, policy, attempt, start, error,
+                                          max(retrier.breaker.remaining(), policy.backoff(attempt)))
+                    log.debug(f"Circuit open while calling {method}(), retrying in {pause:.1f} secs...")
                 # Telegram API didn't answer in time
-                except telegram.error.TimedOut:
-                    log.warning(f"Timed out while calling {func.__name__}(),"
-                                f" retrying in {cfg['Telegram']['timed_out_pause']} secs...")
-                    time.sleep(cfg["Telegram"]["timed_out_pause"])
-                    continue
+                except telegram.error.TimedOut as error:
+                    retrier.breaker.failure()
+                    pause = retrier.pause(method, policy, attempt, start, error, policy.backoff(attempt))
+                    log.warning(f"Timed out while calling {method}(), retrying in {pause:.1f} secs...")
                 # Telegram is not reachable
                 except telegram.error.NetworkError as error:
-                    log.error(f"Network error while calling {func.__name__}(),"
-                              f" retrying in {cfg['Telegram']['error_pause']} secs...\n"
+                    retrier.breaker.failure()
+                    pause = retrier.pause(method, policy, attempt, start, error, policy.backoff(attempt))
+                    log.error(f"Network error while calling {method}(), retrying in {pause:.1f} secs...\n"
                               f"Full error: {error.message}")
-                    time.sleep(cfg["Telegram"]["error_pause"])
-                    continue
                 # Unknown error
                 except telegram.error.TelegramError as error:
-                    if error.message.lower() in ["bad gateway", "invalid server response"]:
-                        log.warning(f"Bad Gateway while calling {func.__name__}(),"
-                                    f" retrying in {cfg['Telegram']['error_pause']} secs...")
-                        time.sleep(cfg["Telegram"]["error_pause"])
-                        continue
-                    elif error.message.lower() == "timed out":
-                        log.warning(f"Timed out while calling {func.__name__}(),"
-                                    f" retrying in {cfg['Telegram']['timed_out_pause']} secs...")
-                        time.sleep(cfg["Telegram"]["timed_out_pause"])
-                        continue
-                    else:
-                        log.error(f"Telegram error while calling {func.__name__}(),"
-                                  f" retrying in {cfg['Telegram']['error_pause']} secs...\n"
-                                  f"Full error: {error.message}")
-                        traceback.print_exception(*sys.exc_info())
-                        time.sleep(cfg["Telegram"]["error_pause"])
-                        continue
+                    pause = retrier.pause(method, policy, attempt, start, error, policy.backoff(attempt))
+                    log.error(f"Telegram error while calling {method}(), retrying in {pause:.1f} secs...\n"
+                              f"Full error: {error.message}")
+                    traceback.print_exception(*sys.exc_info())
+                else:
+                    retrier.breaker.success()
+                    return result
+                conversations.sleep(pause)
 
         return result_func
 
     class DuckBot:
         def __init__(self, *args, **kwargs):
             self.bot = telegram.Bot(token=cfg["Telegram"]["token"], *args, **kwargs)
+            # The retry policies and their counters
+            self.retrier = retrier
+            # The methods sending something to a chat go through the scheduler, to stay within the rate limits
+            outbound_cfg = cfg["Telegram"]["Outbound"]
+            self.outbound = outbound.OutboundScheduler(global_rate=outbound_cfg["global_rate"],
+                                                       global_burst=outbound_cfg["global_burst"],
+                                                       chat_rate=outbound_cfg["chat_rate"],
+                                                       chat_burst=outbound_cfg["chat_burst"],
+                                                       workers=outbound_cfg["workers"],
+                                                       queue_warning=outbound_cfg["queue_warning"])
 
         @catch_telegram_errors
-        def send_message(self, *args, **kwargs):
+        def send_message(self, *args, priority: int = outbound.BROWSING, **kwargs):
             # All messages are sent in HTML parse mode
-            return self.bot.send_message(parse_mode="HTML", *args, **kwargs)
+            return self.outbound.call(chat_id_of(args, kwargs), priority,
+                                      self.bot.send_message, parse_mode="HTML", *args, **kwargs)
 
         @catch_telegram_errors
-        def send_photo(self, *args, **kwargs):
-            return self.bot.send_photo(parse_mode="HTML", *args, **kwargs)
+        def send_photo(self, *args, priority: int = outbound.BROWSING, **kwargs):
+            return self.outbound.call(chat_id_of(args, kwargs), priority,
+                                      self.bot.send_photo, parse_mode="HTML", *args, **kwargs)
 
         @catch_telegram_errors
-        def edit_message_text(self, *args, **kwargs):
+        def edit_message_text(self, *args, priority: int = outbound.BROWSING, **kwargs):
             # All messages are sent in HTML parse mode
-            return self.bot.edit_message_text(parse_mode="HTML", *args, **kwargs)
+            return self.outbound.call(chat_id_of(args, kwargs, 1), priority,
+                                      self.bot.edit_message_text, parse_mode="HTML", *args, **kwargs)
 
         @catch_telegram_errors
-        def edit_message_caption(self, *args, **kwargs):
+        def edit_message_caption(self, *args, priority: int = outbound.BROWSING, **kwargs):
             # All messages are sent in HTML parse mode
-            return self.bot.edit_message_caption(parse_mode="HTML", *args, **kwargs)
+            return self.outbound.call(chat_id_of(args, kwargs), priority,
+                                      self.bot.edit_message_caption, parse_mode="HTML", *args, **kwargs)
 
         @catch_telegram_errors
-        def edit_message_reply_markup(self, *args, **kwargs):
-            return self.bot.edit_message_reply_markup(*args, **kwargs)
+        def edit_message_reply_markup(self, *args, priority: int = outbound.BROWSING, **kwargs):
+            return self.outbound.call(chat_id_of(args, kwargs), priority,
+                                      self.bot.edit_message_reply_markup, *args, **kwargs)
 
         @catch_telegram_errors
         def get_updates(self, *args, **kwargs):
             return self.bot.get_updates(*args, **kwargs)
 
+        @catch_telegram_errors
+        def set_webhook(self, *args, **kwargs):
+            return self.bot.set_webhook(*args, **kwargs)
+
+        @catch_telegram_errors
+        def delete_webhook(self, *args, **kwargs):
+            return self.bot.delete_webhook(*args, **kwargs)
+
         @catch_telegram_errors
         def get_me(self, *args, **kwargs):
             return self.bot.get_me(*args, **kwargs)
 
         @catch_telegram_errors
-        def answer_callback_query(self, *args, **kwargs):
-            return self.bot.answer_callback_query(*args, **kwargs)
+        def answer_callback_query(self, *args, priority: int = outbound.BROWSING, **kwargs):
+            return self.outbound.call(None, priority, self.bot.answer_callback_query, *args, **kwargs)
 
         @catch_telegram_errors
-        def answer_pre_checkout_query(self, *args, **kwargs):
-            return self.bot.answer_pre_checkout_query(*args, **kwargs)
+        def answer_pre_checkout_query(self, *args, priority: int = outbound.PAYMENT, **kwargs):
+            return self.outbound.call(None, priority, self.bot.answer_pre_checkout_query, *args, **kwargs)
 
         @catch_telegram_errors
-        def send_invoice(self, *args, **kwargs):
-            return self.bot.send_invoice(*args, **kwargs)
+        def send_invoice(self, *args, priority: int = outbound.PAYMENT, **kwargs):
+            return self.outbound.call(chat_id_of(args, kwargs), priority, self.bot.send_invoice, *args, **kwargs)
 
         @catch_telegram_errors
         def get_file(self, *args, **kwargs):
             return self.bot.get_file(*args, **kwargs)
 
         @catch_telegram_errors
-        def send_chat_action(self, *args, **kwargs):
-            return self.bot.send_chat_action(*args, **kwargs)
+        def send_chat_action(self, *args, priority: int = outbound.BROWSING, **kwargs):
+            return self.outbound.call(chat_id_of(args, kwargs), priority, self.bot.send_chat_action, *args, **kwargs)
 
         @catch_telegram_errors
-        def delete_message(self, *args, **kwargs):
-            return self.bot.delete_message(*args, **kwargs)
+        def delete_message(self, *args, priority: int = outbound.BROWSING, **kwargs):
+            return self.outbound.call(chat_id_of(args, kwargs), priority, self.bot.delete_message, *args, **kwargs)
 
         @catch_telegram_errors
-        def send_document(self, *args, **kwargs):
-            return self.bot.send_document(*args, **kwargs)
+        def send_document(self, *args, priority: int = outbound.BROWSING, **kwargs):
+            return self.outbound.call(chat_id_of(args, kwargs), priority, self.bot.send_document, *args, **kwargs)
 
         # More methods can be added here
 
@@ -29,5 +29,9 @@ class MethodNotAllowedException(HttpException):
     status_code = 405
 
 
+class ConflictException(HttpException):
+    status_code = 409
+
+
 class SQLException(HttpException):
     status_code = 400
@@ -0,0 +1,193 @@
+import csv
+import datetime
+import io
+import logging
+import tempfile
+from typing import *
+
+import openpyxl
+import sqlalchemy.orm
+
+import database as db
+
+log = logging.getLogger(__name__)
+
+# Rows fetched from the database at a time
+BATCH_SIZE = 500
+
+# Exports smaller than this are kept in memory, bigger ones are moved to a temporary file
+SPOOL_SIZE = 4 * 1024 * 1024
+
+
+class Column(NamedTuple):
+    title: str
+    value: Callable[[Any], Any]
+
+
+TRANSACTION_COLUMNS: List[Column] = [
+    Column("UserID", lambda t: t.user_id),
+    Column("TransactionValue", lambda t: t.value),
+    Column("TransactionNotes", lambda t: t.notes),
+    Column("Provider", lambda t: t.provider),
+    Column("ChargeID", lambda t: t.provider_charge_id),
+    Column("SpecifiedName", lambda t: t.payment_name),
+    Column("SpecifiedPhone", lambda t: t.payment_phone),
+    Column("SpecifiedEmail", lambda t: t.payment_email),
+    Column("Refunded?", lambda t: t.refunded),
+]
+
+
+# The statuses orders can be filtered by
+ORDER_STATUSES = ("pending", "delivered", "refunded")
+
+
+def order_status(row) -> str:
+    # Same precedence as Order.text
+    if row.delivery_date is not None:
+        return "delivered"
+    if row.refund_date is not None:
+        return "refunded"
+    return "pending"
+
+
+# One row for every item of an order, orders without items get a single row with no product
+ORDER_COLUMNS: List[Column] = [
+    Column("OrderID", lambda r: r.order_id),
+    Column("CreationDate", lambda r: r.creation_date),
+    Column("Status", order_status),
+    Column("UserID", lambda r: r.user_id),
+    Column("Username", lambda r: r.username),
+    Column("ProductID", lambda r: r.product_id),
+    Column("ProductName", lambda r: r.product_name),
+    Column("ProductPrice", lambda r: r.product_price),
+    Column("Quantity", lambda r: r.quantity),
+    Column("TrackingNumber", lambda r: r.tracking_number),
+    Column("Notes", lambda r: r.notes),
+    Column("DeliveryDate", lambda r: r.delivery_date),
+    Column("RefundDate", lambda r: r.refund_date),
+    Column("RefundReason", lambda r: r.refund_reason),
+]
+
+
+def parse_date(text: str) -> datetime.date:
+    """Parse a YYYY-MM-DD date, raising ValueError if it isn't one."""
+    return datetime.datetime.strptime(text.strip(), "%Y-%m-%d").date()
+
+
+def query_rows(query: sqlalchemy.orm.Query, columns: List[Column],
+               progress: Optional[Callable[[float], None]] = None) -> Iterator[list]:
+    """Yield the rows of a query, fetching them in batches so that the results are never all in memory.
+    If progress is given, it's called with the fraction of the rows yielded after every batch."""
+    total = query.order_by(None).count() if progress is not None else 0
+    for number, item in enumerate(query.yield_per(BATCH_SIZE), start=1):
+        yield [column.value(item) for column in columns]
+        if total and number % BATCH_SIZE == 0:
+            progress(number / total)
+    if progress is not None:
+        progress(1.0)
+
+
+def write_xlsx(file: BinaryIO, title: str, columns: List[Column], rows: Iterable[list]) -> None:
+    # Write-only workbooks stream the rows instead of keeping every cell in memory
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    sheet.append([column.title for column in columns])
+    for row in rows:
+        sheet.append(row)
+    workbook.save(file)
+
+
+def write_csv(file: BinaryIO, title: str, columns: List[Column], rows: Iterable[list]) -> None:
+    # The BOM lets Excel recognize the file as UTF-8
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text)
+    writer.writerow([column.title for column in columns])
+    for row in rows:
+        writer.writerow(["" if value is None else value for value in row])
+    text.flush()
+    # Leave the file open for the caller
+    text.detach()
+
+
+MIMETYPES: Dict[str, str] = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+}
+
+WRITERS: Dict[str, Callable[[BinaryIO, str, List[Column], Iterable[list]], None]] = {
+    "xlsx": write_xlsx,
+    "csv": write_csv,
+}
+
+
+def export(file_format: str, title: str, columns: List[Column], rows: Iterable[list]) -> BinaryIO:
+    """Write the rows to a new file in the given format, and return it rewound.
+    The file is deleted when it's closed."""
+    file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+        WRITERS[file_format](file, title, columns, rows)
+    except BaseException:
+        file.close()
+        raise
+    file.seek(0)
+    return file
+
+
+def export_transactions(session: sqlalchemy.orm.Session, file_format: str = "xlsx",
+                        progress: Optional[Callable[[float], None]] = None) -> BinaryIO:
+    """Export all the transactions, oldest first."""
+    log.debug(f"Exporting the transactions as {file_format}")
+    query = session.query(db.Transaction).order_by(db.Transaction.transaction_id)
+    return export(file_format, "Transactions", TRANSACTION_COLUMNS, query_rows(query, TRANSACTION_COLUMNS, progress))
+
+
+def orders_query(session: sqlalchemy.orm.Session,
+                 status: Optional[str] = None,
+                 start: Optional[datetime.date] = None,
+                 end: Optional[datetime.date] = None) -> sqlalchemy.orm.Query:
+    """Select the rows of the orders export, oldest first.
+    start and end are included, and filter the orders by their creation date."""
+    # Select plain columns, the relationships of the models are eagerly loaded and can't be fetched in batches
+    query = session.query(db.Order.order_id,
+                          db.Order.creation_date,
+                          db.Order.delivery_date,
+                          db.Order.refund_date,
+                          db.Order.refund_reason,
+                          db.Order.user_id,
+                          db.User.username,
+                          db.Order.notes,
+                          db.Order.tracking_number,
+                          db.OrderItem.quantity,
+                          db.OrderItem.product_id,
+                          db.Product.name.label("product_name"),
+                          db.Product.price.label("product_price")) \
+        .select_from(db.Order) \
+        .outerjoin(db.User, db.Order.user_id == db.User.user_id) \
+        .outerjoin(db.OrderItem, db.OrderItem.order_id == db.Order.order_id) \
+        .outerjoin(db.Product, db.Product.id == db.OrderItem.product_id)
+    if status == "pending":
+        query = query.filter(db.Order.delivery_date == None, db.Order.refund_date == None)
+    elif status == "delivered":
+        query = query.filter(db.Order.delivery_date != None)
+    elif status == "refunded":
+        query = query.filter(db.Order.delivery_date == None, db.Order.refund_date != None)
+    elif status is not None:
+        raise ValueError(f"Unknown order status: {status}")
+    if start is not None:
+        query = query.filter(db.Order.creation_date >= datetime.datetime.combine(start, datetime.time.min))
+    if end is not None:
+        query = query.filter(db.Order.creation_date < datetime.datetime.combine(end + datetime.timedelta(days=1),
+                                                                               datetime.time.min))
+    return query.order_by(db.Order.order_id, db.OrderItem.item_id)
+
+
+def export_orders(session: sqlalchemy.orm.Session,
+                  file_format: str = "xlsx",
+                  status: Optional[str] = None,
+                  start: Optional[datetime.date] = None,
+                  end: Optional[datetime.date] = None,
+                  progress: Optional[Callable[[float], None]] = None) -> BinaryIO:
+    """Export the orders matching the filters, with one row for every ordered product."""
+    log.debug(f"Exporting the orders as {file_format}: status={status} start={start} end={end}")
+    query = orders_query(session, status, start, end)
+    return export(file_format, "Orders", ORDER_COLUMNS, query_rows(query, ORDER_COLUMNS, progress))
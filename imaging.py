@@ -0,0 +1,75 @@
+import io
+import logging
+from typing import *
+
+import nuconfig
+
+try:
+    import PIL.Image
+    import PIL.ImageOps
+except ImportError:
+    PIL = None
+
+log = logging.getLogger(__name__)
+
+# The sizes a product image can be requested in, "full" being the original image
+SIZES = ("thumbnail", "medium", "full")
+
+# Set once the missing Pillow has been reported
+pillow_warned = False
+
+# Pillow names of the formats the variants can be encoded in
+FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+
+
+class Variant(NamedTuple):
+    size: str
+    data: bytes
+    width: int
+    height: int
+
+
+class VariantMaker:
+    """Makes the smaller copies of the product images, which are shown in lists instead of the originals.
+    Requires Pillow: without it no variant is made, and the originals are served in every size."""
+
+    def __init__(self, max_sides: Dict[str, int], image_format: str, quality: int):
+        # The longest side of every variant, in pixels
+        self.max_sides: Dict[str, int] = max_sides
+        self.image_format: str = FORMATS[image_format]
+        self.quality: int = quality
+
+    @classmethod
+    def from_config(cls, cfg: nuconfig.NuConfig) -> "VariantMaker":
+        images_cfg = cfg["Images"]
+        return cls(max_sides={"thumbnail": images_cfg["thumbnail_size"], "medium": images_cfg["medium_size"]},
+                   image_format=images_cfg["variant_format"],
+                   quality=images_cfg["variant_quality"])
+
+    def make(self, data: bytes) -> List[Variant]:
+        """Return the variants of an image, skipping the ones which wouldn't be smaller than the original."""
+        if PIL is None:
+            global pillow_warned
+            if not pillow_warned:
+                log.warning("Pillow is not installed, product images will be served at full size only")
+                pillow_warned = True
+            return []
+        try:
+            original = PIL.Image.open(io.BytesIO(data))
+            # Phone photos are often stored sideways, with the rotation in their EXIF data
+            original = PIL.ImageOps.exif_transpose(original)
+        except (OSError, ValueError) as e:
+            log.warning(f"Could not read an image to make its variants: {e}")
+            return []
+        if self.image_format == "JPEG" and original.mode not in ("RGB", "L"):
+            original = original.convert("RGB")
+        variants = []
+        for size, max_side in sorted(self.max_sides.items(), key=lambda item: item[1]):
+            if max(original.size) <= max_side:
+                continue
+            image = original.copy()
+            image.thumbnail((max_side, max_side), PIL.Image.LANCZOS)
+            output = io.BytesIO()
+            image.save(output, self.image_format, quality=self.quality)
+            variants.append(Variant(size, output.getvalue(), image.width, image.height))
+        return variants
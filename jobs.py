@@ -0,0 +1,105 @@
+import collections
+import concurrent.futures
+import itertools
+import logging
+import threading
+import time
+from typing import *
+
+log = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """The runner already has as many jobs waiting as it accepts."""
+
+
+class Job:
+    """A function run in the background by a JobRunner.
+    The function gets the job as first argument, to report its progress."""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, job_id: int, name: str):
+        self.id: int = job_id
+        self.name: str = name
+        self.status: str = Job.QUEUED
+        # The completed fraction of the job, from 0 to 1, if the job reports it
+        self.progress: Optional[float] = None
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.created: float = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.future: Optional[concurrent.futures.Future] = None
+
+    def __repr__(self):
+        return f"<Job {self.id} {self.name} {self.status}>"
+
+    def report(self, progress: float) -> None:
+        self.progress = min(max(progress, 0.0), 1.0)
+
+
+class JobRunner:
+    """Runs jobs on a fixed number of threads, keeping the last ones for their status to be checked.
+    If max_queued is set, submitting a job while that many are already waiting for a thread raises JobQueueFull."""
+
+    def __init__(self, workers: int, history: int = 100, max_queued: Optional[int] = None,
+                 thread_name_prefix: str = "Job"):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                               thread_name_prefix=thread_name_prefix)
+        self._workers: int = workers
+        self._max_queued: Optional[int] = max_queued
+        self._ids = itertools.count(1)
+        # The jobs by id, oldest first
+        self._jobs: "collections.OrderedDict[int, Job]" = collections.OrderedDict()
+        self._history: int = history
+        self._lock = threading.Lock()
+
+    def submit(self, name: str, func: Callable, *args, **kwargs) -> Job:
+        """Queue func(job, *args, **kwargs) and return its job."""
+        with self._lock:
+            if self._max_queued is not None:
+                active = sum(1 for job in self._jobs.values() if job.status in (Job.QUEUED, Job.RUNNING))
+                if active >= self._workers + self._max_queued:
+                    raise JobQueueFull(f"{active} jobs are already running or waiting")
+            job = Job(next(self._ids), name)
+            self._jobs[job.id] = job
+            self._forget_finished()
+        job.future = self._executor.submit(self._run, job, func, args, kwargs)
+        log.debug(f"Queued {job}")
+        return job
+
+    def get(self, job_id: int) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of the known jobs in every status."""
+        with self._lock:
+            counts = collections.Counter(job.status for job in self._jobs.values())
+        return {status: counts[status] for status in (Job.QUEUED, Job.RUNNING, Job.DONE, Job.FAILED)}
+
+    def _forget_finished(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in (Job.DONE, Job.FAILED)]
+        for job_id in finished[:max(0, len(self._jobs) - self._history)]:
+            del self._jobs[job_id]
+
+    @staticmethod
+    def _run(job: Job, func: Callable, args: tuple, kwargs: dict):
+        job.status = Job.RUNNING
+        job.started = time.time()
+        try:
+            job.result = func(job, *args, **kwargs)
+        except Exception as e:
+            job.error = e
+            job.status = Job.FAILED
+            log.error(f"{job} failed: {e}", exc_info=True)
+        else:
+            job.status = Job.DONE
+            log.debug(f"{job} completed in {time.time() - job.started:.1f} secs")
+        finally:
+            job.finished = time.time()
+        return job.result
@@ -0,0 +1,121 @@
+import datetime
+import logging
+from typing import *
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, String, DateTime
+
+import database as db
+
+log = logging.getLogger(__name__)
+
+# The versions of the migrations applied to the database, kept out of the models' metadata
+schema_metadata = sqlalchemy.MetaData()
+schema_version = sqlalchemy.Table("schema_version", schema_metadata,
+                                  Column("version", Integer, primary_key=True),
+                                  Column("description", String, nullable=False),
+                                  Column("applied_at", DateTime, nullable=False))
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[sqlalchemy.engine.Connection], None]
+
+
+def add_column(connection: sqlalchemy.engine.Connection, table_name: str, column_name: str) -> None:
+    """Add a column of the models to an existing table, if it's not there already."""
+    existing = {column["name"] for column in sqlalchemy.inspect(connection).get_columns(table_name)}
+    if column_name in existing:
+        return
+    column = db.TableDeclarativeBase.metadata.tables[table_name].columns[column_name]
+    log.info(f"Adding the column {table_name}.{column_name}")
+    connection.execute(sqlalchemy.text(
+        f"ALTER TABLE {table_name} ADD COLUMN "
+        f"{sqlalchemy.schema.CreateColumn(column).compile(dialect=connection.dialect)}"))
+
+
+def create_index(connection: sqlalchemy.engine.Connection, table_name: str, index_name: str) -> None:
+    """Create an index of the models on an existing table, if it's not there already."""
+    existing = {index["name"] for index in sqlalchemy.inspect(connection).get_indexes(table_name)}
+    if index_name in existing:
+        return
+    table = db.TableDeclarativeBase.metadata.tables[table_name]
+    index = next(index for index in table.indexes if index.name == index_name)
+    log.info(f"Creating the index {index_name} on {table_name}")
+    index.create(connection)
+
+
+def add_missing_columns_and_indexes(connection: sqlalchemy.engine.Connection) -> None:
+    # Before the migrations, create_all was followed by adding the missing columns of the models,
+    # which were the ones added to the product images; their indexes were never created on existing tables
+    for column_name in ["sha256", "width", "height", "telegram_file_id"]:
+        add_column(connection, "product_images", column_name)
+    for index_name in ["ix_product_images_product_id", "ix_product_images_sha256"]:
+        create_index(connection, "product_images", index_name)
+
+
+def add_hot_query_indexes(connection: sqlalchemy.engine.Connection) -> None:
+    for table_name, index_name in [("cart", "ix_cart_user_product"),
+                                   ("orders", "ix_orders_user_id"),
+                                   ("orders", "ix_orders_pending"),
+                                   ("orderitems", "ix_orderitems_order_id"),
+                                   ("transactions", "ix_transactions_order_id"),
+                                   ("admins", "ix_admins_live_mode"),
+                                   ("products", "ix_products_deleted_name"),
+                                   ("product_images", "ix_product_images_product_id")]:
+        create_index(connection, table_name, index_name)
+
+
+def add_order_item_quantity(connection: sqlalchemy.engine.Connection) -> None:
+    # The bot used to store an item per unit ordered, and these keep the default quantity of 1
+    add_column(connection, "orderitems", "quantity")
+    # The API stored a single item, and the quantity on the order
+    orders = db.Order.__table__
+    items = db.OrderItem.__table__
+    single_item_orders = sqlalchemy.select(items.c.order_id) \
+        .group_by(items.c.order_id) \
+        .having(sqlalchemy.func.count() == 1)
+    order_quantity = sqlalchemy.select(orders.c.quantity) \
+        .where(orders.c.order_id == items.c.order_id) \
+        .scalar_subquery()
+    connection.execute(items.update()
+                       .where(items.c.order_id.in_(single_item_orders))
+                       .where(order_quantity > 1)
+                       .values(quantity=order_quantity))
+
+
+def add_idempotency_key_token(connection: sqlalchemy.engine.Connection) -> None:
+    add_column(connection, "idempotency_keys", "token")
+
+
+# Every schema change of existing databases, in order. Never edit or remove an applied migration, add a new one.
+# Migrations must be idempotent: new databases are created with the current models, and then run all of them.
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Add the columns and indexes added to the models before versioning", add_missing_columns_and_indexes),
+    Migration(2, "Index the columns filtered by the hot queries", add_hot_query_indexes),
+    Migration(3, "Store the quantity of every order item", add_order_item_quantity),
+    Migration(4, "Store the token of the request handling an idempotency key", add_idempotency_key_token),
+]
+
+
+def applied_versions(connection: sqlalchemy.engine.Connection) -> Set[int]:
+    return set(connection.execute(sqlalchemy.select(schema_version.c.version)).scalars())
+
+
+def upgrade(engine) -> List[Migration]:
+    """Create the missing tables, then apply the migrations which haven't been applied yet, each in its own
+    transaction. Return the applied migrations."""
+    db.TableDeclarativeBase.metadata.create_all(engine)
+    schema_metadata.create_all(engine)
+    with engine.connect() as connection:
+        applied = applied_versions(connection)
+    pending = [migration for migration in MIGRATIONS if migration.version not in applied]
+    for migration in pending:
+        log.info(f"Applying migration {migration.version}: {migration.description}")
+        with engine.begin() as connection:
+            migration.apply(connection)
+            connection.execute(schema_version.insert().values(version=migration.version,
+                                                              description=migration.description,
+                                                              applied_at=datetime.datetime.now()))
+    return pending
@@ -1,4 +1,5 @@
 import logging
+import os
 from typing import *
 
 import toml
@@ -89,3 +90,14 @@ class NuConfig:
             result["__missing__"] = missing
 
         return result
+
+
+def load_config(config_path: Optional[str] = None) -> NuConfig:
+    """Load the config file used by the bot, from CONFIG_PATH or config/config.toml by default.
+    Falls back to the template if the default file has not been created yet."""
+    if config_path is None:
+        config_path = os.environ.get("CONFIG_PATH", "config/config.toml")
+        if not os.path.isfile(config_path):
+            config_path = "config/template_config.toml"
+    with open(config_path, encoding="utf8") as cfg_file:
+        return NuConfig(cfg_file)
@@ -0,0 +1,124 @@
+import datetime
+import logging
+from typing import *
+
+import sqlalchemy.orm
+
+import database as db
+
+log = logging.getLogger(__name__)
+
+
+class OrderError(Exception):
+    """The order can't be placed, because of what was ordered."""
+
+
+def order_lines(quantities: Mapping[int, int]) -> Dict[int, int]:
+    """Check the quantity ordered of every product, and drop the products which aren't ordered."""
+    lines = {}
+    for product_id, quantity in quantities.items():
+        try:
+            quantity = int(quantity)
+        except (TypeError, ValueError):
+            raise OrderError(f"Invalid quantity for the product {product_id}: {quantity}")
+        if quantity < 0:
+            raise OrderError(f"Invalid quantity for the product {product_id}: {quantity}")
+        if quantity > 0:
+            lines[int(product_id)] = lines.get(int(product_id), 0) + quantity
+    if not lines:
+        raise OrderError("The order is empty")
+    return lines
+
+
+def create_order(session: sqlalchemy.orm.Session,
+                 user_id: int,
+                 quantities: Mapping[int, int],
+                 notes: str,
+                 value: Optional[int] = None,
+                 tracking_number: Optional[str] = None) -> db.Order:
+    """Place an order of the products, by id, in the given quantities, and commit it.
+    The order, one item per product holding its quantity and, if a value is given, the transaction paying for it
+    are written in a single transaction: a failure leaves nothing behind."""
+    lines = order_lines(quantities)
+    # Only products which are still on sale can be ordered
+    on_sale = set(session.execute(
+        sqlalchemy.select(db.Product.id).where(db.Product.id.in_(lines),
+                                               db.Product.deleted == False,
+                                               db.Product.price != None)
+    ).scalars())
+    if missing := [product_id for product_id in lines if product_id not in on_sale]:
+        raise OrderError(f"Products not on sale: {', '.join(map(str, missing))}")
+    try:
+        order = add_order(session, user_id, sum(lines.values()), notes, tracking_number)
+        # Insert all the items with one statement
+        session.execute(db.OrderItem.__table__.insert(),
+                        [{"order_id": order.order_id, "product_id": product_id, "quantity": quantity}
+                         for product_id, quantity in lines.items()])
+        if value is not None:
+            session.add(db.Transaction(user_id=user_id, value=value, order=order))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    log.debug(f"Created order {order.order_id} of {len(lines)} products for user {user_id}")
+    return order
+
+
+def checkout_cart(session: sqlalchemy.orm.Session,
+                  user_id: int,
+                  notes: str,
+                  tracking_number: Optional[str] = None) -> db.Order:
+    """Turn the cart of the user into an order, and commit it.
+    The items are copied from the cart with a single INSERT ... SELECT, and the cart is emptied in the same
+    transaction: a failure leaves the cart as it was and no order behind."""
+    cart = db.Cart.__table__
+    ordered = sqlalchemy.and_(cart.c.user_id == str(user_id), cart.c.quantity > 0)
+    try:
+        # Lock the cart, where the database supports it, so that nothing is added to it before it's emptied
+        rows = session.execute(
+            sqlalchemy.select(cart.c.quantity, db.Product.id)
+            .select_from(cart)
+            .outerjoin(db.Product, sqlalchemy.and_(db.Product.id == cart.c.product_id,
+                                                   db.Product.deleted == False,
+                                                   db.Product.price != None))
+            .where(ordered)
+            .with_for_update(of=cart)
+        ).all()
+        if not rows:
+            raise OrderError("The cart is empty")
+        if any(product_id is None for _, product_id in rows):
+            raise OrderError("Some products of the cart are not on sale")
+        units = sum(quantity for quantity, _ in rows)
+        order = add_order(session, user_id, units, notes, tracking_number)
+        # A product added twice to the cart becomes a single item
+        session.execute(db.OrderItem.__table__.insert().from_select(
+            ["order_id", "product_id", "quantity"],
+            sqlalchemy.select(sqlalchemy.literal(order.order_id),
+                              cart.c.product_id,
+                              sqlalchemy.func.sum(cart.c.quantity))
+            .where(ordered)
+            .group_by(cart.c.product_id)
+        ))
+        session.execute(cart.delete().where(cart.c.user_id == str(user_id)))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    log.debug(f"Created order {order.order_id} from the cart of user {user_id}")
+    return order
+
+
+def add_order(session: sqlalchemy.orm.Session,
+              user_id: int,
+              quantity: int,
+              notes: str,
+              tracking_number: Optional[str]) -> db.Order:
+    """Add a new order without items to the session, and flush it to get its id."""
+    order = db.Order(user_id=user_id,
+                     creation_date=datetime.datetime.now(),
+                     notes=notes,
+                     tracking_number=tracking_number,
+                     quantity=quantity)
+    session.add(order)
+    session.flush()
+    return order
@@ -0,0 +1,221 @@
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+from typing import *
+
+import telegram.error
+
+import conversations
+
+log = logging.getLogger(__name__)
+
+# The priority lanes of the outbound requests, the lower the sooner
+PAYMENT = 0
+ORDER = 1
+BROWSING = 2
+LANE_NAMES = ["payment", "order", "browsing"]
+
+# Seconds after which the buckets of the chats which haven't been sent anything are dropped
+BUCKET_CLEANUP_INTERVAL = 60
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, and bursts of up to capacity requests.
+    Not thread-safe, the scheduler only uses it while holding its lock."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic()
+        self.paused_until: float = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Return the seconds to wait before a token is available, 0 if there is one right now."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds: float, now: float) -> None:
+        """Stop handing out tokens for some seconds, after which a single request is allowed before refilling."""
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 1
+        self.updated = self.paused_until
+
+    def is_full(self, now: float) -> bool:
+        return now >= self.paused_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class OutboundRequest:
+    __slots__ = ("chat_id", "priority", "func", "args", "kwargs", "future", "queued")
+
+    def __init__(self, chat_id: Optional[int], priority: int, func: Callable, args: tuple, kwargs: dict):
+        self.chat_id: Optional[int] = chat_id
+        self.priority: int = priority
+        self.func: Callable = func
+        self.args: tuple = args
+        self.kwargs: dict = kwargs
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.queued: float = time.monotonic()
+
+
+class OutboundScheduler:
+    """Sends the requests to the Bot API within the global and per-chat rate limits of Telegram.
+    Requests are queued in priority lanes, and the first one whose chat is not throttled is sent by a pool of
+    threads as soon as the global limit allows it.
+    The requests of the same chat and lane are sent in order."""
+
+    def __init__(self, global_rate: float, global_burst: float, chat_rate: float, chat_burst: float,
+                 workers: int, queue_warning: int):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate: float = chat_rate
+        self.chat_burst: float = chat_burst
+        self.workers: int = workers
+        self.queue_warning: int = queue_warning
+        self._lanes: List[Deque[OutboundRequest]] = [collections.deque() for _ in LANE_NAMES]
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._condition = threading.Condition()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Outbound")
+        self._in_flight: int = 0
+        self._overloaded: bool = False
+        # Counters for the metrics
+        self._sent: int = 0
+        self._rate_limited: int = 0
+        self._wait_total: float = 0.0
+        self._wait_max: float = 0.0
+        self._thread = threading.Thread(target=self._run, name="Outbound scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, chat_id: Optional[int], priority: int, func: Callable, /, *args,
+               **kwargs) -> concurrent.futures.Future:
+        """Queue a call to the Bot API, limited by the bucket of chat_id if it's not None."""
+        request = OutboundRequest(chat_id, priority, func, args, kwargs)
+        with self._condition:
+            self._lanes[priority].append(request)
+            queued = self._queued()
+            if queued >= self.queue_warning and not self._overloaded:
+                self._overloaded = True
+                log.warning(f"{queued} requests are waiting to be sent to Telegram")
+            self._condition.notify()
+        return request.future
+
+    def call(self, chat_id: Optional[int], priority: int, func: Callable, /, *args, **kwargs):
+        """Queue a call to the Bot API and wait for its result.
+        Conversations are suspended while waiting, so that the other conversations of their lane keep running."""
+        return conversations.result(self.submit(chat_id, priority, func, *args, **kwargs))
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Return the figures to monitor the backpressure on the outbound requests."""
+        with self._condition:
+            now = time.monotonic()
+            stats = {f"queued_{name}": len(lane) for name, lane in zip(LANE_NAMES, self._lanes)}
+            stats.update({
+                "in_flight": self._in_flight,
+                "sent": self._sent,
+                "rate_limited": self._rate_limited,
+                "chat_buckets": len(self._chat_buckets),
+                "oldest_wait": max((now - lane[0].queued for lane in self._lanes if lane), default=0.0),
+                "average_wait": self._wait_total / self._sent if self._sent else 0.0,
+                "max_wait": self._wait_max,
+            })
+            return stats
+
+    def _queued(self) -> int:
+        return sum(len(lane) for lane in self._lanes)
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _run(self):
+        next_cleanup = time.monotonic() + BUCKET_CLEANUP_INTERVAL
+        with self._condition:
+            while True:
+                timeout = self._send_ready()
+                now = time.monotonic()
+                if now >= next_cleanup:
+                    self._chat_buckets = {chat_id: bucket for chat_id, bucket in self._chat_buckets.items()
+                                          if not bucket.is_full(now)}
+                    next_cleanup = now + BUCKET_CLEANUP_INTERVAL
+                if timeout is None or timeout > next_cleanup - now:
+                    timeout = next_cleanup - now
+                self._condition.wait(timeout)
+
+    def _send_ready(self) -> Optional[float]:
+        """Send the requests which are allowed right now.
+        Return the seconds until the next one will be, or None to wait for a new request or a free thread."""
+        if self._overloaded and self._queued() < self.queue_warning:
+            self._overloaded = False
+        while self._in_flight < self.workers:
+            now = time.monotonic()
+            delay = self.global_bucket.delay(now)
+            if delay > 0:
+                return delay
+            request, delay = self._next_request(now)
+            if request is None:
+                return delay
+            self.global_bucket.take(now)
+            if request.chat_id is not None:
+                self._bucket(request.chat_id).take(now)
+            wait = now - request.queued
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            self._in_flight += 1
+            self._executor.submit(self._execute, request)
+        return None
+
+    def _next_request(self, now: float) -> Tuple[Optional[OutboundRequest], Optional[float]]:
+        """Remove and return the first request of the highest priority lane whose chat isn't throttled.
+        If all of them are, return the seconds until the first one won't be."""
+        shortest_delay = None
+        throttled = set()
+        for lane in self._lanes:
+            for position, request in enumerate(lane):
+                if request.chat_id is None:
+                    delay = 0.0
+                elif request.chat_id in throttled:
+                    continue
+                else:
+                    delay = self._bucket(request.chat_id).delay(now)
+                if delay == 0:
+                    del lane[position]
+                    return request, None
+                throttled.add(request.chat_id)
+                if shortest_delay is None or delay < shortest_delay:
+                    shortest_delay = delay
+        return None, shortest_delay
+
+    def _execute(self, request: OutboundRequest) -> None:
+        try:
+            result = request.func(*request.args, **request.kwargs)
+        except telegram.error.RetryAfter as error:
+            # Telegram asked to slow down: hold back the chat, or every request if it isn't bound to one
+            with self._condition:
+                self._rate_limited += 1
+                bucket = self.global_bucket if request.chat_id is None else self._bucket(request.chat_id)
+                bucket.pause(error.retry_after, time.monotonic())
+            request.future.set_exception(error)
+        except BaseException as error:
+            request.future.set_exception(error)
+        else:
+            request.future.set_result(result)
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._sent += 1
+                self._condition.notify()
@@ -1,9 +1,9 @@
 from flask import Blueprint
 from flask import request
 from flask import send_from_directory
-from controller.api_worker import api_worker
+from controller.api_worker import api_worker, idempotency_keys
 import os
-from utils import wrap_resp
+from utils import wrap_resp, exception_decorate
 
 web_service_app = Blueprint(
     'api_app', __name__, url_prefix='/api')
@@ -17,6 +17,7 @@ def ping():
 
 # 加入购物车
 @web_service_app.route('/addCart', methods=['POST'])
+@idempotency_keys.idempotent
 @wrap_resp
 def add_cart():
     params = request.get_json(force=True)
@@ -24,6 +25,7 @@ def add_cart():
 
 # 移除购物车
 @web_service_app.route('/removeCart', methods=['POST'])
+@idempotency_keys.idempotent
 @wrap_resp
 def remove_cart():
     params = request.get_json(force=True)
@@ -43,12 +45,19 @@ def order_list():
     params = request.get_json(force=True)
     return api_worker.order_list(params)
 
+# 商品图片
+@web_service_app.route('/image/<int:image_id>', methods=['GET'])
+@exception_decorate
+def product_image(image_id):
+    return api_worker.product_image(image_id, request.args.get('size', 'full'))
+
 # 商品列表
 @web_service_app.route('/productList', methods=['POST'])
 @wrap_resp
 def product_list():
-    # params = request.get_json(force=True)
-    return api_worker.product_list()
+    # 老版本前端不传参数
+    params = request.get_json(force=True, silent=True) or {}
+    return api_worker.product_list(params)
 
 # 搜索商品
 @web_service_app.route('/productSearch', methods=['POST'])
@@ -67,11 +76,26 @@ def product_detail():
 
 # 创建订单
 @web_service_app.route('/order', methods=['POST'])
+@idempotency_keys.idempotent
 @wrap_resp
 def create_order():
     params = request.get_json(force=True)
     return api_worker.create_order(params)
 
+# 购物车结算，整个购物车生成一个订单
+@web_service_app.route('/checkout', methods=['POST'])
+@idempotency_keys.idempotent
+@wrap_resp
+def checkout():
+    params = request.get_json(force=True)
+    return api_worker.checkout(params)
+
+# 导出订单
+@web_service_app.route('/export/orders', methods=['GET'])
+@exception_decorate
+def export_orders():
+    return api_worker.export_orders(request.args, request.headers.get('Authorization'))
+
 # 轮播图
 @web_service_app.route('/slider/<path:filename>', methods=['GET'])
 def send_image(filename):
@@ -0,0 +1,24 @@
+from flask import Blueprint
+from flask import current_app, request
+from exceptions import BadRequestException, NotFoundException, UnauthorizedException
+from utils import wrap_resp
+
+telegram_app = Blueprint(
+    'telegram_app', __name__, url_prefix='/telegram')
+
+
+# Telegram webhook, only served by the bot process when [Telegram] mode is "webhook"
+@telegram_app.route('/<secret>', methods=['POST'])
+@wrap_resp
+def receive_update(secret):
+    dispatcher = current_app.extensions.get('telegram_dispatcher')
+    if dispatcher is None:
+        raise NotFoundException('NOT_FOUND', 'webhook is not enabled')
+    if not dispatcher.check_secret(secret, request.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+        raise UnauthorizedException('UNAUTHORIZED', 'invalid secret')
+    update = request.get_json(force=True, silent=True)
+    if not isinstance(update, dict) or 'update_id' not in update:
+        raise BadRequestException('INVALID_PARAMETERS', 'invalid update')
+    # Answer right away, the update is handled by the dispatcher thread
+    dispatcher.put_json(update)
+    return True
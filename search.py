@@ -0,0 +1,198 @@
+import logging
+import re
+from typing import *
+
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy import text
+
+import database as db
+
+log = logging.getLogger(__name__)
+
+# Chinese, Japanese and Korean characters are not separated by spaces, so every one of them is indexed as a word
+CJK_CHARACTER = re.compile(r"([\u2e80-\u2fdf\u3040-\u30ff\u3100-\u312f\u3400-\u4dbf\u4e00-\u9fff"
+                           r"\uac00-\ud7af\uf900-\ufaff])")
+WORD = re.compile(r"\w+")
+
+# A position in the ranked hits: the (score, product id) of the last returned hit
+Position = Tuple[float, int]
+
+
+def tokenize(string: Optional[str]) -> str:
+    """Prepare a text for the full-text index, splitting CJK text into single characters."""
+    return CJK_CHARACTER.sub(r" \1 ", string or "")
+
+
+def query_terms(keyword: str) -> List[List[str]]:
+    """Split a search keyword into terms, each one being the list of the tokens it must match in order."""
+    terms = []
+    for term in keyword.split():
+        tokens = WORD.findall(tokenize(term))
+        if tokens:
+            terms.append(tokens)
+    return terms
+
+
+class SearchIndex:
+    """A full-text index over the names and descriptions of the products which have not been deleted.
+    The hits are ranked by score, lower is better, and paginated on the (score, product id) keyset."""
+
+    name = "like"
+
+    def setup(self, engine) -> None:
+        """Create the index if it does not exist, and fill it if it is empty."""
+        pass
+
+    def update(self, session, product: db.Product) -> None:
+        """Index the current name and description of a product, inside the transaction of the session."""
+        pass
+
+    def remove(self, session, product_id: int) -> None:
+        """Remove a product from the index, inside the transaction of the session."""
+        pass
+
+    def search(self, session, keyword: str, after: Optional[Position] = None,
+               limit: Optional[int] = None) -> Tuple[List[int], Optional[Position]]:
+        """Find the ids of the products matching the keyword, best first.
+        The second value is the position to resume from, or None if there are no more hits."""
+        query = session.query(db.Product.id).filter_by(deleted=False)
+        for term in keyword.split():
+            query = query.filter(sqlalchemy.or_(db.Product.name.ilike(f"%{term}%"),
+                                                db.Product.description.ilike(f"%{term}%")))
+        if after is not None:
+            query = query.filter(db.Product.id > after[1])
+        query = query.order_by(db.Product.id)
+        if limit is not None:
+            query = query.limit(limit + 1)
+        return self._paginate([(row.id, 0.0) for row in query.all()], limit)
+
+    def rebuild(self, session) -> None:
+        """Index again all the products which have not been deleted."""
+        products = session.query(db.Product).filter_by(deleted=False).all()
+        for product in products:
+            self.update(session, product)
+        log.info(f"Indexed {len(products)} products for the {self.name} search")
+
+    @staticmethod
+    def _paginate(hits: List[Tuple[int, float]], limit: Optional[int]) -> Tuple[List[int], Optional[Position]]:
+        if limit is not None and len(hits) > limit:
+            last_id, last_score = hits[limit - 1]
+            return [product_id for product_id, _ in hits[:limit]], (last_score, last_id)
+        return [product_id for product_id, _ in hits], None
+
+    def _ranked_search(self, session, statement: str, params: dict, after: Optional[Position],
+                       limit: Optional[int]) -> Tuple[List[int], Optional[Position]]:
+        # The statement selects (product_id, score) for every hit
+        sql = f"SELECT product_id, score FROM ({statement}) AS hits"
+        if after is not None:
+            sql += " WHERE score > :after_score OR (score = :after_score AND product_id > :after_id)"
+            params.update(after_score=after[0], after_id=after[1])
+        sql += " ORDER BY score, product_id"
+        if limit is not None:
+            sql += " LIMIT :limit"
+            params["limit"] = limit + 1
+        rows = session.execute(text(sql), params).fetchall()
+        return self._paginate([(row.product_id, row.score) for row in rows], limit)
+
+    def _needs_rebuild(self, connection, table: str) -> bool:
+        indexed = connection.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+        return indexed == 0 and connection.execute(
+            sqlalchemy.select([sqlalchemy.func.count()]).select_from(db.Product.__table__)
+            .where(db.Product.deleted == False)
+        ).scalar() > 0
+
+
+class SqliteSearchIndex(SearchIndex):
+    """A FTS5 virtual table, whose rowid is the product id."""
+
+    name = "fts5"
+
+    def setup(self, engine) -> None:
+        with engine.begin() as connection:
+            connection.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS product_search "
+                                    "USING fts5(name, description, tokenize='unicode61')"))
+            rebuild = self._needs_rebuild(connection, "product_search")
+        if rebuild:
+            session = sqlalchemy.orm.Session(bind=engine)
+            self.rebuild(session)
+            session.commit()
+            session.close()
+
+    def update(self, session, product: db.Product) -> None:
+        self.remove(session, product.id)
+        session.execute(text("INSERT INTO product_search (rowid, name, description) "
+                             "VALUES (:id, :name, :description)"),
+                        {"id": product.id, "name": tokenize(product.name),
+                         "description": tokenize(product.description)})
+
+    def remove(self, session, product_id: int) -> None:
+        session.execute(text("DELETE FROM product_search WHERE rowid = :id"), {"id": product_id})
+
+    def search(self, session, keyword: str, after: Optional[Position] = None,
+               limit: Optional[int] = None) -> Tuple[List[int], Optional[Position]]:
+        terms = query_terms(keyword)
+        if not terms:
+            return super().search(session, keyword, after, limit)
+        # Every term is a phrase whose last token can be a prefix, and all the terms must match
+        match = " ".join('"' + " ".join(tokens) + '" *' for tokens in terms)
+        # Matches in the name weigh more than the ones in the description
+        statement = "SELECT rowid AS product_id, bm25(product_search, 10.0, 1.0) AS score " \
+                    "FROM product_search WHERE product_search MATCH :match"
+        return self._ranked_search(session, statement, {"match": match}, after, limit)
+
+
+class PostgresSearchIndex(SearchIndex):
+    """A table of tsvector documents with a GIN index, using the simple configuration on the tokenized text."""
+
+    name = "tsvector"
+
+    def setup(self, engine) -> None:
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE IF NOT EXISTS product_search ("
+                                    "product_id INTEGER PRIMARY KEY REFERENCES products (id), "
+                                    "document TSVECTOR NOT NULL)"))
+            connection.execute(text("CREATE INDEX IF NOT EXISTS ix_product_search_document "
+                                    "ON product_search USING GIN (document)"))
+            rebuild = self._needs_rebuild(connection, "product_search")
+        if rebuild:
+            session = sqlalchemy.orm.Session(bind=engine)
+            self.rebuild(session)
+            session.commit()
+            session.close()
+
+    def update(self, session, product: db.Product) -> None:
+        session.execute(text("INSERT INTO product_search (product_id, document) "
+                             "VALUES (:id, setweight(to_tsvector('simple', :name), 'A') || "
+                             "setweight(to_tsvector('simple', :description), 'B')) "
+                             "ON CONFLICT (product_id) DO UPDATE SET document = excluded.document"),
+                        {"id": product.id, "name": tokenize(product.name),
+                         "description": tokenize(product.description)})
+
+    def remove(self, session, product_id: int) -> None:
+        session.execute(text("DELETE FROM product_search WHERE product_id = :id"), {"id": product_id})
+
+    def search(self, session, keyword: str, after: Optional[Position] = None,
+               limit: Optional[int] = None) -> Tuple[List[int], Optional[Position]]:
+        terms = query_terms(keyword)
+        if not terms:
+            return super().search(session, keyword, after, limit)
+        # The tokens only contain word characters, so they can be quoted safely
+        query = " & ".join("(" + " <-> ".join(f"'{token}'" for token in tokens) + ":*)" for tokens in terms)
+        # ts_rank is higher for better hits, negate it to sort like bm25
+        statement = "SELECT product_id, -ts_rank(document, to_tsquery('simple', :query))::float8 AS score " \
+                    "FROM product_search WHERE document @@ to_tsquery('simple', :query)"
+        return self._ranked_search(session, statement, {"query": query}, after, limit)
+
+
+def for_engine(engine) -> SearchIndex:
+    """Pick the search backend supported by the dialect of the engine."""
+    if engine.dialect.name == "sqlite":
+        with engine.connect() as connection:
+            options = [row[0] for row in connection.execute(text("PRAGMA compile_options"))]
+        if "ENABLE_FTS5" in options:
+            return SqliteSearchIndex()
+        log.warning("SQLite was compiled without FTS5, falling back to LIKE product search")
+    elif engine.dialect.name == "postgresql":
+        return PostgresSearchIndex()
+    return SearchIndex()
@@ -5,6 +5,8 @@ from flask_cors import CORS
 from urllib import parse
 from utils import failReturn
 from router.api_app import web_service_app
+from router.telegram_app import telegram_app
+from controller.api_worker import session as db_session
 
 # flask server
 server = Flask(__name__)
@@ -17,12 +19,13 @@ server = Flask(__name__)
 #         if blueprint is not None:
 
 server.register_blueprint(web_service_app)
+server.register_blueprint(telegram_app)
 CORS(server)
 
 
-# @server.before_request
-# def before_request():
-#     g.session = db_session()
+@server.before_request
+def before_request():
+    g.session = db_session()
 #     path = request.path
 #     if 'Authorization' not in request.headers:
 #         response = make_response(
@@ -46,9 +49,10 @@ CORS(server)
 #     g.current = current_dict
 
 
-# @server.teardown_request
-# def teardown_request(exception):
-#     g.session.close()
+@server.teardown_request
+def teardown_request(exception):
+    # Roll back anything left uncommitted and return the connection to the pool, even if the request failed
+    db_session.remove()
 
 
 @server.errorhandler(404)
@@ -52,6 +52,15 @@ csv_caption = "A 📄 .xlsx file containing all transactions stored in the bot d
               "You can open this file with other programs, such as Office, to process" \
               " the data."
 
+# Orders file caption
+orders_file_caption = "📄 The orders you selected, one row for every ordered product."
+
+# Export: the file will be generated in the background
+export_queued = "🕒 I'm preparing the file, I'll send it here when it's ready. You can keep using the bot meanwhile."
+
+# Export: progress of the file being generated
+export_progress = "⏳ Preparing the file... {percent}%"
+
 # Conversation: the start command was sent and the bot should welcome the user
 conversation_after_start = "Hello!\n" \
                            "Welcome to TGgreed!\n" \
@@ -66,6 +75,12 @@ conversation_open_user_menu = "What would you like to do?\n" \
                               "If the keyboard has not opened, you can open it by pressing the button with four small" \
                               " squares in the message bar.</i>"
 
+# Conversation: select the status of the orders to export
+conversation_export_orders_status = "Which orders do you want to export?"
+
+# Conversation: select the format of the orders file
+conversation_export_orders_format = "In which format should I send the file?"
+
 # Conversation: like above, but for administrators
 conversation_open_admin_menu = "You are a 💼 <b>Manager</b> of this store!\n" \
                                "What would you like to do?\n" \
@@ -128,6 +143,9 @@ conversation_expired = "🕐  I haven't received any messages in a while, so I c
                        " resources.\n" \
                        "If you want to start a new one, send a new /start command."
 
+conversation_evicted = "🕐  The bot is very busy right now, so I closed our conversation to make room for other users.\n" \
+                       "If you want to start a new one, send a new /start command."
+
 # User menu: order
 menu_order = "🛒 Order products"
 
@@ -212,6 +230,18 @@ menu_contact_shopkeeper = "👨‍💼 Contact the store"
 # Menu: generate transactions .csv file
 menu_csv = "📄 .xlsx"
 
+# Menu: generate a .csv file
+menu_csv_file = "📄 .csv"
+
+# Admin menu: export orders
+menu_export_orders = "📄 Export orders"
+
+# Export orders: status filters
+menu_all_orders = "All orders"
+menu_pending_orders = "Pending orders"
+menu_delivered_orders = "Completed orders"
+menu_refunded_orders = "Refunded orders"
+
 # Menu: edit admins list
 menu_edit_admins = "🏵 Edit Managers"
 
@@ -260,6 +290,12 @@ ask_product_image = "🖼 What image do you want the product to have?\n" \
                     "\n" \
                     "<i>Send the photo, or Skip this phase and don't add any image.</i>"
 
+# Export orders: ask for the range of creation dates
+ask_export_orders_dates = "Send the first and the last day of the orders to export, like " \
+                          "<code>2024-01-01 2024-01-31</code>.\n" \
+                          "\n" \
+                          "<i>Press the Skip button below this message to export the orders of every day.</i>"
+
 # Order product: notes?
 ask_order_notes = "Would you like to leave a note along with the order?\n" \
                   "💼 It will be visible to the store Managers.\n" \
@@ -303,6 +339,9 @@ downloading_image = "I'm downloading your photo!\n" \
                     "It might take a while... Please be patient!\n" \
                     "I won't be able to answer you while I'm downloading."
 
+# The image of a product will be downloaded in the background
+image_download_queued = "🕒 I'm downloading the photo in the background, I'll tell you when it has been added."
+
 # Edit product: current value
 edit_current_value = "The current value is:\n" \
                      "<pre>{value}</pre>\n" \
@@ -368,6 +407,9 @@ contact_shopkeeper = "Currently, the staff available to provide user assistance
 # Success: product has been added/edited to the database
 success_product_edited = "✅ The product has been successfully added/modified!"
 
+# Success: the image downloaded in the background has been added to the product
+success_product_image_attached = "✅ The photo of <b>{name}</b> has been added!"
+
 # Success: product has been added/edited to the database
 success_product_deleted = "✅ The product has been successfully deleted!"
 
@@ -417,12 +459,37 @@ error_not_enough_credit = "⚠️ You do not have enough credit to place the ord
 # Error: order has already been cleared
 error_order_already_cleared = "⚠️  This order has already been processed."
 
+# Error: a product of the order is no longer on sale
+error_order_products_unavailable = "⚠️ Some of the products are no longer available, so the order was not placed."
+
 # Error: no orders have been placed, so none can be shown
 error_no_orders = "⚠️  You haven't placed any order yet, so there is nothing to display."
 
 # Error: selected user does not exist
 error_user_does_not_exist = "⚠️  The selected user does not exist."
 
+# Error: too many exports are already being generated
+error_export_busy = "⚠️ Too many files are being prepared right now, please try again in a few minutes."
+
+# Error: the export could not be generated
+error_export_failed = "⚠️ The file could not be prepared because of an error."
+
+# Error: the export is larger than the files Telegram accepts
+error_export_too_large = "⚠️ The file is too large to be sent through Telegram ({size} MB).\n" \
+                         "Please export less data, for example a shorter date range."
+
+# Error: the dates of the export are not valid
+error_invalid_dates = "⚠️ These dates are not valid, the first day must come before the last one."
+
+# Error: the image of a product could not be downloaded
+error_product_image_download = "⚠️ The photo of <b>{name}</b> could not be downloaded, please send it again."
+
+# Error: the image of a product could not be added
+error_product_image_failed = "⚠️ The photo of <b>{name}</b> could not be added because of an error."
+
+# Error: the product was deleted before its image was added
+error_product_image_product_deleted = "⚠️ <b>{name}</b> was deleted before its photo could be added."
+
 # Fatal: conversation raised an exception
 fatal_conversation_exception = "☢️ Oh no! An <b>error</b> interrupted this conversation\n" \
                                "The error was reported to the bot owner so that he can fix it.\n" \
@@ -71,6 +71,21 @@ conversation_open_user_menu = "尊敬的顾客你好，欢迎光临π幻想！\n
                               "<a href='{conversation_open_user_menu_img}'>&#8205;</a>" \
                               "<i>请按底部键盘上的键以选择操作.</i> \n" 
 
+# Conversation: select the status of the orders to export
+conversation_export_orders_status = "您要导出哪些订单?"
+
+# Conversation: select the format of the orders file
+conversation_export_orders_format = "您要哪种格式的文件?"
+
+# Orders file caption
+orders_file_caption = "📄 您选择的订单，每个订购的商品一行."
+
+# Export: the file will be generated in the background
+export_queued = "🕒 我正在准备文件，完成后会发送到这里。在此期间您可以继续使用机器人."
+
+# Export: progress of the file being generated
+export_progress = "⏳ 正在准备文件... {percent}%"
+
 # Conversation: like above, but for administrators
 conversation_open_admin_menu = "您是这家店的💼 <b>经理</b>\n" \
                                "您想做什么?\n" \
@@ -134,6 +149,9 @@ conversation_expired = "🕐  我有一段时间没有收到任何消息，因
                        "资源.\n" \
                        "如果您要开始一个新的，发送一个新的 /start 命令."
 
+conversation_evicted = "🕐  机器人当前非常繁忙，因此我关闭了我们的对话，以便为其他用户腾出空间.\n" \
+                       "如果您要开始一个新的，发送一个新的 /start 命令."
+
 # User menu: order
 menu_order = "🛒 商品列表"
 
@@ -232,6 +250,18 @@ menu_contact_shopkeeper = "👨‍💼 联系客服"
 # Menu: generate transactions .csv file
 menu_csv = "📄 .xlsx"
 
+# Menu: generate a .csv file
+menu_csv_file = "📄 .csv"
+
+# Admin menu: export orders
+menu_export_orders = "📄 导出订单"
+
+# Export orders: status filters
+menu_all_orders = "全部订单"
+menu_pending_orders = "待定订单"
+menu_delivered_orders = "已完成订单"
+menu_refunded_orders = "已退还订单"
+
 # Menu: edit admins list
 menu_edit_admins = "🏵 编辑经理"
 
@@ -280,6 +310,11 @@ ask_product_image = "🖼 您希望产品具有什么图片？\n" \
                     "\n" \
                     "<i>发送照片，或跳过此阶段不添加任何图像。</i>"
 
+# Export orders: ask for the range of creation dates
+ask_export_orders_dates = "请发送要导出订单的第一天和最后一天，例如 <code>2024-01-01 2024-01-31</code>.\n" \
+                          "\n" \
+                          "<i>按下此消息下方的跳过按钮以导出所有日期的订单.</i>"
+
 # Order product: notes?
 ask_order_notes = "请输入你要的快递&收货信息\n" \
                   "💼 这将对商店经理可见。\n" \
@@ -326,6 +361,9 @@ downloading_image = "我正在下载您的照片\n" \
                     "这可能需要一段时间...请耐心等待\n" \
                     "下载时，我将无法回复您。"
 
+# The image of a product will be downloaded in the background
+image_download_queued = "🕒 我正在后台下载照片，添加完成后会通知您。"
+
 # Edit product: current value
 edit_current_value = "当前值为:\n" \
                      "<pre>{value}</pre>\n" \
@@ -402,6 +440,9 @@ contact_shopkeeper = "目前在线的支持人员包括: \n" \
 # Success: product has been added/edited to the database
 success_product_edited = "✅ 产品已成功添加/修改"
 
+# Success: the image downloaded in the background has been added to the product
+success_product_image_attached = "✅ <b>{name}</b> 的照片已添加"
+
 # Success: product has been marked as deleted in the database
 success_product_deleted = "✅ 该产品已成功删除!"
 
@@ -450,12 +491,36 @@ error_not_enough_credit = "⚠️ 您的信用额不足，无法下订单."
 # Error: order has already been cleared
 error_order_already_cleared = "⚠️  该订单已被处理."
 
+# Error: a product of the order is no longer on sale
+error_order_products_unavailable = "⚠️ 部分商品已下架，订单未能创建。"
+
 # Error: no orders have been placed, so none can be shown
 error_no_orders = "⚠️  您尚未下任何订单，因此无任何显示."
 
 # Error: selected user does not exist
 error_user_does_not_exist = "⚠️  所选用户不存在."
 
+# Error: too many exports are already being generated
+error_export_busy = "⚠️ 当前正在准备的文件太多，请几分钟后再试."
+
+# Error: the export could not be generated
+error_export_failed = "⚠️ 由于出现错误，无法准备文件."
+
+# Error: the export is larger than the files Telegram accepts
+error_export_too_large = "⚠️ 文件太大（{size} MB），无法通过 Telegram 发送，请减少导出的数据，例如缩短日期范围."
+
+# Error: the dates of the export are not valid
+error_invalid_dates = "⚠️ 日期无效，第一天必须早于最后一天."
+
+# Error: the image of a product could not be downloaded
+error_product_image_download = "⚠️ 无法下载 <b>{name}</b> 的照片，请重新发送."
+
+# Error: the image of a product could not be added
+error_product_image_failed = "⚠️ 由于发生错误，无法添加 <b>{name}</b> 的照片."
+
+# Error: the product was deleted before its image was added
+error_product_image_product_deleted = "⚠️ <b>{name}</b> 在照片添加完成前已被删除."
+
 # Fatal: conversation raised an exception
 fatal_conversation_exception = "☢️ 啊啊啊啊! 一个 <b>error</b> 阻止了此对话\n" \
                                "该错误已报告给机器人所有者，以便他可以修复它\n" \
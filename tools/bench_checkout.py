@@ -0,0 +1,136 @@
+"""Benchmark of concurrent checkouts on a SQLite database file.
+
+Run it from the repository root with:
+
+    python -m tools.bench_checkout [--processes 4] [--seconds 10] [--lines 3] [--quantity 2]
+
+Every process opens the engine of dbruntime on the same file, with the [Database] settings of the template config,
+and places orders of --lines random products, --quantity units each, until the time is up.
+It runs once with the old way of placing an order: commit the order, load every product, commit one item per unit
+ordered, then load the order again; and once with orders.create_order, which does it all in one transaction.
+Failed orders are mostly "database is locked" errors.
+"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
+
+import database as db
+import dbruntime
+import migrations
+import nuconfig
+import orders
+
+PRODUCTS = 2_000
+USERS = 1_000
+
+
+def load_db_cfg() -> dict:
+    with open("config/template_config.toml", encoding="utf8") as cfg_file:
+        return nuconfig.NuConfig(cfg_file)["Database"]
+
+
+def fill(url: str):
+    engine = sqlalchemy.create_engine(url)
+    migrations.upgrade(engine)
+    with engine.begin() as connection:
+        connection.execute(db.User.__table__.insert(),
+                           [{"user_id": i, "first_name": f"User {i}", "credit": 0, "language": "en"}
+                            for i in range(1, USERS + 1)])
+        connection.execute(db.Product.__table__.insert(),
+                           [{"id": i, "name": f"Product {i}", "description": "Description", "price": 100,
+                             "deleted": False} for i in range(1, PRODUCTS + 1)])
+    engine.dispose()
+
+
+def legacy_checkout(session: sqlalchemy.orm.Session, user_id: int, quantities: dict):
+    order = db.Order(user_id=user_id, notes="Notes", tracking_number="", creation_date=datetime.datetime.now(),
+                     quantity=sum(quantities.values()))
+    session.add(order)
+    session.commit()
+    for product_id, quantity in quantities.items():
+        product = session.query(db.Product).filter_by(id=product_id).one()
+        for _ in range(quantity):
+            session.add(db.OrderItem(order=order, product=product))
+    session.commit()
+    session.query(db.Order).filter_by(order_id=order.order_id).one()
+
+
+def service_checkout(session: sqlalchemy.orm.Session, user_id: int, quantities: dict):
+    orders.create_order(session, user_id=user_id, quantities=quantities, notes="Notes", tracking_number="")
+
+
+CHECKOUTS = {
+    "legacy": legacy_checkout,
+    "service": service_checkout,
+}
+
+
+def run(arguments):
+    mode, url, seconds, lines, quantity = arguments
+    engine = dbruntime.create_engine(url, load_db_cfg())
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    checkout = CHECKOUTS[mode]
+    timings = []
+    errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        user_id = random.randint(1, USERS)
+        quantities = {product_id: quantity for product_id in random.sample(range(1, PRODUCTS + 1), lines)}
+        start = time.perf_counter()
+        try:
+            checkout(session, user_id, quantities)
+        except sqlalchemy.exc.OperationalError:
+            session.rollback()
+            errors += 1
+            continue
+        timings.append(time.perf_counter() - start)
+        # Don't let the identity map grow with every order
+        session.expunge_all()
+    session.close()
+    engine.dispose()
+    return timings, errors
+
+
+def report(mode: str, results, seconds: float, url: str):
+    timings = sorted(timing for result in results for timing in result[0])
+    errors = sum(result[1] for result in results)
+    engine = sqlalchemy.create_engine(url)
+    with engine.connect() as connection:
+        rows = connection.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(db.OrderItem.__table__))
+        items = rows.scalar()
+    engine.dispose()
+    if timings:
+        print(f"{mode:>8} {len(timings) / seconds:>10.0f} {statistics.median(timings) * 1e3:>10.2f} "
+              f"{timings[int(len(timings) * 0.99)] * 1e3:>10.2f} {errors:>8} {items:>10}")
+    else:
+        print(f"{mode:>8} {'-':>10} {'-':>10} {'-':>10} {errors:>8} {items:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--lines", type=int, default=3, help="products in every order")
+    parser.add_argument("--quantity", type=int, default=2, help="units of every product ordered")
+    args = parser.parse_args()
+    print(f"{'checkout':>8} {'orders/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'failed':>8} {'item rows':>10}")
+    for mode in CHECKOUTS:
+        with tempfile.TemporaryDirectory() as directory:
+            url = f"sqlite:///{os.path.join(directory, 'bench.sqlite')}"
+            fill(url)
+            with multiprocessing.Pool(args.processes) as pool:
+                results = pool.map(run, [(mode, url, args.seconds, args.lines, args.quantity)] * args.processes)
+            report(mode, results, args.seconds, url)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Regression benchmark of the /api/productDetail lookup when the catalogue cache is cold.
+
+Run it from the repository root with:
+
+    python -m tools.bench_product_detail
+
+It fills a temporary SQLite database with catalogues of growing size, then times
+CatalogueCache.load_product for random products. The latency should stay flat.
+"""
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import sqlalchemy
+import sqlalchemy.orm
+
+import database as db
+from controller.catalogue import CatalogueCache
+
+SIZES = [100, 1_000, 10_000, 100_000]
+LOOKUPS = 500
+IMAGE = b"\xff\xd8\xff" + bytes(4096)
+
+
+def fill(engine, start: int, stop: int):
+    with engine.begin() as connection:
+        connection.execute(db.Product.__table__.insert(),
+                           [{"id": i, "name": f"Product {i}", "description": "Description", "price": 100,
+                             "deleted": False} for i in range(start, stop)])
+        connection.execute(db.ProductImage.__table__.insert(),
+                           [{"product_id": i, "data": IMAGE} for i in range(start, stop)])
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(directory, 'bench.sqlite')}")
+        db.TableDeclarativeBase.metadata.create_all(engine)
+        session = sqlalchemy.orm.sessionmaker(bind=engine)()
+        print(f"{'products':>10} {'median us':>10} {'p95 us':>10}")
+        filled = 1
+        for size in SIZES:
+            fill(engine, filled, size + 1)
+            filled = size + 1
+            timings = []
+            for _ in range(LOOKUPS):
+                product_id = random.randint(1, size)
+                start = time.perf_counter()
+                product = CatalogueCache.load_product(session, product_id)
+                timings.append(time.perf_counter() - start)
+                assert product["product_id"] == product_id
+            timings.sort()
+            print(f"{size:>10} {statistics.median(timings) * 1e6:>10.0f} {timings[int(LOOKUPS * 0.95)] * 1e6:>10.0f}")
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Micro-benchmark of controller.catalogue.group_product_rows.
+
+Run it from the repository root with:
+
+    python -m tools.bench_product_grouping
+
+Every product gets two images, like the joined rows loaded by the catalogue cache.
+The time per row should stay roughly constant from 100 to 100k products.
+"""
+import collections
+import time
+
+from controller.catalogue import group_product_rows
+
+Row = collections.namedtuple("Row", ["id", "name", "price", "description", "image_id"])
+
+IMAGES_PER_PRODUCT = 2
+SIZES = [100, 1_000, 10_000, 100_000]
+
+
+def make_rows(products: int):
+    return [Row(product_id, f"Product {product_id}", 100, "Description", product_id * IMAGES_PER_PRODUCT + image)
+            for product_id in range(products)
+            for image in range(IMAGES_PER_PRODUCT)]
+
+
+def main():
+    print(f"{'products':>10} {'rows':>10} {'total ms':>10} {'us/row':>8}")
+    for size in SIZES:
+        rows = make_rows(size)
+        start = time.perf_counter()
+        products = group_product_rows(rows)
+        elapsed = time.perf_counter() - start
+        assert len(products) == size
+        print(f"{size:>10} {len(rows):>10} {elapsed * 1000:>10.1f} {elapsed * 1e6 / len(rows):>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
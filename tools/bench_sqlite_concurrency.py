@@ -0,0 +1,128 @@
+"""Benchmark of concurrent cart writes and catalogue reads on a SQLite database file.
+
+Run it from the repository root with:
+
+    python -m tools.bench_sqlite_concurrency [--processes 4] [--seconds 10] [--write-ratio 0.2]
+
+Like the gunicorn workers of the API, every process opens its own engine on the same file, then adds products to
+random carts or reads a page of the catalogue until the time is up. It runs once with a plain engine, which uses
+the rollback journal, and once with the engine of dbruntime and the [Database] settings of the template config.
+Failed operations are mostly "database is locked" errors.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
+
+import database as db
+import dbruntime
+import migrations
+import nuconfig
+
+PRODUCTS = 2_000
+USERS = 5_000
+PAGE_SIZE = 50
+
+
+def load_db_cfg() -> dict:
+    with open("config/template_config.toml", encoding="utf8") as cfg_file:
+        return nuconfig.NuConfig(cfg_file)["Database"]
+
+
+def make_engine(mode: str, url: str):
+    if mode == "tuned":
+        return dbruntime.create_engine(url, load_db_cfg())
+    return sqlalchemy.create_engine(url)
+
+
+def fill(url: str):
+    engine = sqlalchemy.create_engine(url)
+    migrations.upgrade(engine)
+    with engine.begin() as connection:
+        connection.execute(db.Product.__table__.insert(),
+                           [{"id": i, "name": f"Product {i}", "description": "Description", "price": 100,
+                             "deleted": False} for i in range(1, PRODUCTS + 1)])
+    engine.dispose()
+
+
+def add_to_cart(session: sqlalchemy.orm.Session):
+    user_id = str(random.randint(1, USERS))
+    product_id = random.randint(1, PRODUCTS)
+    item = session.query(db.Cart).filter_by(user_id=user_id, product_id=product_id).first()
+    if item is None:
+        session.add(db.Cart(user_id=user_id, product_id=product_id, quantity=1, amount=100))
+    else:
+        item.quantity += 1
+        item.amount += 100
+    session.commit()
+
+
+def read_catalogue(session: sqlalchemy.orm.Session):
+    start = random.randint(0, PRODUCTS - PAGE_SIZE)
+    products = session.query(db.Product.id, db.Product.name, db.Product.price) \
+        .filter(db.Product.deleted == False, db.Product.id > start) \
+        .order_by(db.Product.id) \
+        .limit(PAGE_SIZE) \
+        .all()
+    assert len(products) == PAGE_SIZE
+    session.commit()
+
+
+def run(arguments):
+    mode, url, seconds, write_ratio = arguments
+    engine = make_engine(mode, url)
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    timings = {"write": [], "read": []}
+    errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        kind = "write" if random.random() < write_ratio else "read"
+        start = time.perf_counter()
+        try:
+            add_to_cart(session) if kind == "write" else read_catalogue(session)
+        except sqlalchemy.exc.OperationalError:
+            session.rollback()
+            errors += 1
+            continue
+        timings[kind].append(time.perf_counter() - start)
+    session.close()
+    engine.dispose()
+    return timings, errors
+
+
+def report(mode: str, results, seconds: float):
+    errors = sum(result[1] for result in results)
+    for kind in ("read", "write"):
+        timings = sorted(timing for result in results for timing in result[0][kind])
+        if not timings:
+            continue
+        print(f"{mode:>8} {kind:>6} {len(timings) / seconds:>10.0f} "
+              f"{statistics.median(timings) * 1e3:>10.2f} {timings[int(len(timings) * 0.99)] * 1e3:>10.2f}")
+    print(f"{mode:>8} {'failed':>6} {errors:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    args = parser.parse_args()
+    print(f"{'engine':>8} {'op':>6} {'ops/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for mode in ("default", "tuned"):
+        with tempfile.TemporaryDirectory() as directory:
+            url = f"sqlite:///{os.path.join(directory, 'bench.sqlite')}"
+            fill(url)
+            with multiprocessing.Pool(args.processes) as pool:
+                results = pool.map(run, [(mode, url, args.seconds, args.write_ratio)] * args.processes)
+            report(mode, results, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Check that the hot queries of the bot and of the API are answered through their indexes.
+
+Run it from the repository root with:
+
+    python -m tools.explain_hot_queries [--engine DATABASE_URL]
+
+Without --engine, it makes a temporary SQLite database, drops the indexes of the hot queries as if it had been
+created before they existed, and upgrades it with the migrations. With --engine, the database is upgraded first.
+Every query is run through EXPLAIN, and the script fails if the plan doesn't use the expected index.
+On PostgreSQL sequential scans are disabled while explaining, as the planner prefers them on small tables.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from typing import *
+
+import sqlalchemy
+import sqlalchemy.orm
+
+import database as db
+import migrations
+
+# Description, query and index expected in its plan
+HOT_QUERIES: List[Tuple[str, Callable[[sqlalchemy.orm.Session], sqlalchemy.orm.Query], str]] = [
+    ("cart item of a user", lambda s: s.query(db.Cart).filter_by(user_id="1", product_id=1), "ix_cart_user_product"),
+    ("orders of a user", lambda s: s.query(db.Order).filter_by(user_id=1), "ix_orders_user_id"),
+    ("pending orders", lambda s: s.query(db.Order).filter_by(delivery_date=None, refund_date=None),
+     "ix_orders_pending"),
+    ("items of an order", lambda s: s.query(db.OrderItem).filter_by(order_id=1), "ix_orderitems_order_id"),
+    ("transaction of an order", lambda s: s.query(db.Transaction).filter_by(order_id=1), "ix_transactions_order_id"),
+    ("admins in live mode", lambda s: s.query(db.Admin).filter_by(live_mode=True), "ix_admins_live_mode"),
+    ("products not deleted", lambda s: s.query(db.Product).filter_by(deleted=False), "ix_products_deleted_name"),
+    ("product by name", lambda s: s.query(db.Product).filter_by(name="Product", deleted=False),
+     "ix_products_deleted_name"),
+    ("images of a product", lambda s: s.query(db.ProductImage).filter_by(product_id=1),
+     "ix_product_images_product_id"),
+]
+
+
+def explain(connection: sqlalchemy.engine.Connection, query: sqlalchemy.orm.Query) -> str:
+    sql = str(query.statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+    if connection.dialect.name == "sqlite":
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")
+        return "\n".join(row[-1] for row in rows)
+    return "\n".join(row[0] for row in connection.exec_driver_sql(f"EXPLAIN {sql}"))
+
+
+def drop_hot_indexes(engine) -> None:
+    """Make the database look like one created before the hot query indexes."""
+    names = {index for _, _, index in HOT_QUERIES}
+    with engine.begin() as connection:
+        for table in db.TableDeclarativeBase.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in names:
+                    index.drop(connection)
+        connection.execute(migrations.schema_version.delete().where(migrations.schema_version.c.version >= 2))
+
+
+def check(engine) -> bool:
+    applied = migrations.upgrade(engine)
+    print(f"Applied {len(applied)} migrations")
+    session = sqlalchemy.orm.Session(bind=engine)
+    passed = True
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        for description, make_query, index in HOT_QUERIES:
+            plan = explain(connection, make_query(session))
+            uses_index = index in plan
+            passed = passed and uses_index
+            print(f"{'ok' if uses_index else 'FAIL':<5} {description:<25} {index}")
+            if not uses_index:
+                print("      " + plan.replace("\n", "\n      "))
+    session.close()
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", help="database to check, a temporary SQLite database if not given")
+    args = parser.parse_args()
+    if args.engine:
+        passed = check(sqlalchemy.create_engine(args.engine))
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(directory, 'explain.sqlite')}")
+            migrations.upgrade(engine)
+            drop_hot_indexes(engine)
+            passed = check(engine)
+            engine.dispose()
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Fake Telegram server posting updates to a local webhook.
+
+Start the bot with [Telegram] mode = "webhook" and a fixed webhook_secret, then run from the repository root:
+
+    python -m tools.fake_telegram_poster --secret <webhook_secret>
+
+It posts private chat messages like Telegram would, a /start for every chat followed by text messages, and
+prints how long the webhook took to acknowledge them. The acknowledgement should not depend on how long the
+bot takes to handle the updates.
+"""
+import argparse
+import itertools
+import statistics
+import time
+
+import requests
+
+update_ids = itertools.count(1)
+
+
+def message_update(chat_id: int, text: str) -> dict:
+    user = {"id": chat_id, "is_bot": False, "first_name": f"Fake {chat_id}", "language_code": "en"}
+    return {
+        "update_id": next(update_ids),
+        "message": {
+            "message_id": next(update_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text,
+            **({"entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]}
+               if text.startswith("/") else {}),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8443", help="base url of the webhook server")
+    parser.add_argument("--secret", required=True, help="the webhook_secret of the bot")
+    parser.add_argument("--chats", type=int, default=10, help="number of fake chats")
+    parser.add_argument("--messages", type=int, default=5, help="messages sent in every chat after /start")
+    parser.add_argument("--first-chat-id", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    session = requests.Session()
+    session.headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret
+    url = f"{args.url.rstrip('/')}/telegram/{args.secret}"
+    chat_ids = range(args.first_chat_id, args.first_chat_id + args.chats)
+    updates = [message_update(chat_id, "/start") for chat_id in chat_ids]
+    updates += [message_update(chat_id, f"Message {number}")
+                for number in range(args.messages) for chat_id in chat_ids]
+
+    timings = []
+    for update in updates:
+        start = time.perf_counter()
+        response = session.post(url, json=update, timeout=10)
+        timings.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            print(f"Update {update['update_id']} was refused: {response.status_code} {response.text}")
+    timings.sort()
+    print(f"{len(updates)} updates posted, acknowledged in {statistics.median(timings) * 1000:.1f} ms median, "
+          f"{timings[int(len(timings) * 0.95)] * 1000:.1f} ms p95")
+
+
+if __name__ == "__main__":
+    main()
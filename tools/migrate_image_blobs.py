@@ -0,0 +1,101 @@
+"""Move the product images stored in the product_images table to the image store of the [Images] config section.
+
+Run it from the repository root, preferably while the bot is stopped, with:
+
+    python -m tools.migrate_image_blobs [--vacuum]
+
+Every image is written to the store under its sha256, identical images being stored once, and its row only keeps
+the hash and the dimensions of the image. Images which have already been moved are skipped, so the migration can
+be interrupted and run again. On SQLite, --vacuum shrinks the database file once the blobs are gone.
+
+The thumbnail and medium variants are made for the moved images and for the stored images which don't have any,
+unless --skip-variants is passed. Making them requires Pillow.
+"""
+import argparse
+import os
+
+import sqlalchemy
+import sqlalchemy.orm
+
+import blobstore
+import database as db
+import dbruntime
+import imaging
+import migrations
+import nuconfig
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default=os.environ.get("CONFIG_PATH", "config/config.toml"))
+    parser.add_argument("--engine", help="database url, defaults to DB_ENGINE or the one of the config file")
+    parser.add_argument("--batch-size", type=int, default=100, help="images moved in every transaction")
+    parser.add_argument("--keep-data", action="store_true", help="copy the images without removing them from the table")
+    parser.add_argument("--skip-variants", action="store_true", help="don't make the smaller copies of the images")
+    parser.add_argument("--vacuum", action="store_true", help="run VACUUM on SQLite databases after the migration")
+    args = parser.parse_args()
+
+    cfg = nuconfig.load_config(args.config)
+    engine = dbruntime.create_engine(args.engine or dbruntime.database_url(cfg), cfg["Database"])
+    migrations.upgrade(engine)
+    store = blobstore.from_config(cfg)
+    variant_maker = None if args.skip_variants else imaging.VariantMaker.from_config(cfg)
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+
+    moved = 0
+    stored = set()
+    last_id = 0
+    while True:
+        images = session.query(db.ProductImage) \
+            .options(sqlalchemy.orm.undefer(db.ProductImage.data)) \
+            .filter(db.ProductImage.id > last_id) \
+            .filter(db.ProductImage.sha256 == None) \
+            .filter(db.ProductImage.data != None) \
+            .order_by(db.ProductImage.id) \
+            .limit(args.batch_size) \
+            .all()
+        if not images:
+            break
+        for image in images:
+            data = image.data
+            image.store_data(data, store, variant_maker)
+            if args.keep_data:
+                image.data = data
+            stored.add(image.sha256)
+        last_id = images[-1].id
+        moved += len(images)
+        session.commit()
+        session.expunge_all()
+        print(f"Moved {moved} images")
+    print(f"{moved} images moved to the {store.name} store as {len(stored)} distinct files")
+
+    if variant_maker is not None and imaging.PIL is not None:
+        completed = 0
+        last_id = 0
+        while True:
+            images = session.query(db.ProductImage) \
+                .filter(db.ProductImage.id > last_id) \
+                .filter(db.ProductImage.sha256 != None) \
+                .filter(~db.ProductImage.variants.any()) \
+                .order_by(db.ProductImage.id) \
+                .limit(args.batch_size) \
+                .all()
+            if not images:
+                break
+            for image in images:
+                image.add_variants(store.get(image.sha256), store, variant_maker)
+            last_id = images[-1].id
+            completed += len(images)
+            session.commit()
+            session.expunge_all()
+        print(f"Checked the variants of {completed} stored images")
+    session.close()
+
+    if args.vacuum and engine.dialect.name == "sqlite":
+        print("Vacuuming the database...")
+        with engine.connect() as connection:
+            connection.execute(sqlalchemy.text("VACUUM"))
+
+
+if __name__ == "__main__":
+    main()
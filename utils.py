@@ -1,4 +1,5 @@
 import logging
+import struct
 from functools import wraps
 from datetime import datetime
 import simplejson as json
@@ -8,6 +9,7 @@ from exceptions import (HttpException, UnauthorizedException,
                         AccessDeniedException, SQLException)
 from schematics.exceptions import ModelConversionError, ModelValidationError
 import traceback
+from typing import Optional, Tuple
 
 
 log = logging.getLogger(__name__)
@@ -60,6 +62,58 @@ def telegram_html_escape(string: str):
         .replace('"', "&quot;")
 
 
+def image_mimetype(data: bytes) -> str:
+    """Guess the mimetype of an image from its magic bytes. Telegram photos are always JPEG."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+# The JPEG start of frame markers, which are followed by the size of the image
+JPEG_SOF_MARKERS = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
+
+
+def image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """Read the (width, height) of a JPEG, PNG, GIF or WebP image from its header, None if it can't be found."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if data.startswith((b"GIF87a", b"GIF89a")) and len(data) >= 10:
+        return struct.unpack("<HH", data[6:10])
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", data[26:30])
+            return width & 0x3fff, height & 0x3fff
+        if chunk == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if chunk == b"VP8X":
+            return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+        return None
+    if data.startswith(b"\xff\xd8"):
+        position = 2
+        while position + 9 <= len(data):
+            if data[position] != 0xff:
+                return None
+            marker = data[position + 1]
+            # Padding and markers without a length
+            if marker == 0xff:
+                position += 1
+                continue
+            if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+                position += 2
+                continue
+            if marker in JPEG_SOF_MARKERS:
+                height, width = struct.unpack(">HH", data[position + 5:position + 9])
+                return width, height
+            position += 2 + struct.unpack(">H", data[position + 2:position + 4])[0]
+    return None
+
+
 def json_response(data=None, status='SUCCESS'):
     resp = successReturn(data=data, status=status)
     return LCJSONEncoder().encode(resp)
@@ -1,28 +1,38 @@
 import os
-import io
 import sys
 import datetime
 import logging
 import queue as queuem
 import re
-import threading
+import time
 import traceback
 import uuid
-import csv
-import openpyxl
 from html import escape
 from typing import *
 
-import requests
 import sqlalchemy
 import telegram
 
+import blobstore
 import database as db
+import exports
+import imaging
+import jobs as jobsm
 import localization
+import conversations
 import nuconfig
+import orders
+import outbound
+import search
+from downloader import Downloader, DownloadError
 
 log = logging.getLogger(__name__)
 
+# Minimum seconds between two updates of the progress message of an export
+EXPORT_PROGRESS_INTERVAL = 3.0
+# Largest file a bot can send through the Bot API
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
 
 class StopSignal:
     """A data class that should be sent to the worker when the conversation has to be stopped abnormally."""
@@ -36,8 +46,9 @@ class CancelSignal:
     pass
 
 
-class Worker(threading.Thread):
-    """A worker for a single conversation. A new one is created every time the /start command is sent."""
+class Worker(conversations.Conversation):
+    """A worker for a single conversation. A new one is created every time the /start command is sent.
+    It is run by a lane of the conversation pool, and only uses it while handling an update."""
 
     def __init__(self,
                  bot,
@@ -45,24 +56,35 @@ class Worker(threading.Thread):
                  telegram_user: telegram.User,
                  cfg: nuconfig.NuConfig,
                  engine,
-                 *args,
-                 **kwargs):
-        # Initialize the thread
-        super().__init__(name=f"Worker {chat.id}", *args, **kwargs)
+                 search_index: search.SearchIndex,
+                 pool: conversations.ConversationPool,
+                 jobs: jobsm.JobRunner,
+                 export_jobs: jobsm.JobRunner,
+                 downloader: Downloader):
+        # Initialize the conversation
+        super().__init__(pool, chat.id, name=f"Worker {chat.id}")
         # Store the bot, chat info and config inside the class
         self.bot = bot
         self.chat: telegram.Chat = chat
         self.telegram_user: telegram.User = telegram_user
         self.cfg = cfg
         self.loc = None
+        # The full-text index to keep in sync with the product edits
+        self.search_index = search_index
+        # The store of the product images
+        self.blob_store = blobstore.from_config(cfg)
+        self.variant_maker = imaging.VariantMaker.from_config(cfg)
+        # The background jobs, and the HTTP connection pool they download the product images with
+        self.jobs = jobs
+        self.downloader = downloader
+        # The exports run in the background, shared by all the admins so that they don't overload the database
+        self.export_jobs = export_jobs
         # Open a new database session
         log.debug(f"Opening new database session for {self.name}")
         self.session = sqlalchemy.orm.sessionmaker(bind=engine)()
         # Get the user db data from the users and admin tables
         self.user: Optional[db.User] = None
         self.admin: Optional[db.Admin] = None
-        # The sending pipe is stored in the Worker class, allowing the forwarding of messages to the chat process
-        self.queue = queuem.Queue()
         # The current active invoice payload; reject all invoices with a different payload
         self.invoice_payload = None
         # The price class of this worker.
@@ -226,12 +248,13 @@ class Worker(threading.Thread):
         # Change this if more parameters are added!
         return self.loc is not None
 
-    def stop(self, reason: str = ""):
+    def stop(self, reason: str = "", wait: bool = True):
         """Gracefully stop the worker process"""
-        # Send a stop message to the thread
+        # Send a stop message to the conversation
         self.queue.put(StopSignal(reason))
-        # Wait for the thread to stop
-        self.join()
+        # Wait for the conversation to stop
+        if wait:
+            self.join()
 
     def update_user(self) -> db.User:
         """Update the user data."""
@@ -727,19 +750,7 @@ class Worker(threading.Thread):
         self.bot.send_message(self.chat.id, self.loc.get("ask_order_notes"), reply_markup=cancel)
         # Wait for user input
         notes = self.__wait_for_regex(r"(.*)", cancellable=True)
-        # Create a new Order
-        order = db.Order(user=self.user,
-                         creation_date=datetime.datetime.now(),
-                         notes=notes if not isinstance(notes, CancelSignal) else "")
-        # Add the record to the session and get an ID
-        self.session.add(order)
-        # For each product added to the cart, create a new OrderItem
-        for product in cart:
-            # Create {quantity} new OrderItems
-            for i in range(0, cart[product][1]):
-                order_item = db.OrderItem(product=cart[product][0],
-                                          order=order)
-                self.session.add(order_item)
+        notes = notes if not isinstance(notes, CancelSignal) else ""
         # Ensure the user has enough credit to make the purchase
         # credit_required = self.__get_cart_value(cart) - self.user.credit
         credit_required = self.__get_cart_value(cart) - 99999999
@@ -753,13 +764,10 @@ class Worker(threading.Thread):
                     credit_required <= \
                     self.Price(self.cfg["Payments"]["CreditCard"]["max_amount"]):
                 self.__make_payment(self.Price(credit_required))
-        # If afer requested payment credit is still insufficient (either payment failure or cancel)
-        if self.user.credit < self.__get_cart_value(cart):
-            # Rollback all the changes
-            self.session.rollback()
-        else:
+        # If afer requested payment credit is still insufficient (either payment failure or cancel), give up
+        if self.user.credit >= self.__get_cart_value(cart):
             # User has credit and valid order, perform transaction now
-            self.__order_transaction(order=order, value=-int(self.__get_cart_value(cart)))
+            self.__order_transaction(cart=cart, notes=notes, value=-int(self.__get_cart_value(cart)))
 
     def __get_cart_value(self, cart):
         # Calculate total items value in cart
@@ -778,14 +786,18 @@ class Worker(threading.Thread):
                                                          cart_qty=cart[product_id][1]) + "\n"
         return product_list
 
-    def __order_transaction(self, order, value):
-        # Create a new transaction and add it to the session
-        transaction = db.Transaction(user=self.user,
-                                     value=value,
-                                     order=order)
-        self.session.add(transaction)
-        # Commit all the changes
-        self.session.commit()
+    def __order_transaction(self, cart, notes, value):
+        # Create the order, its items and the transaction paying for it, all at once
+        try:
+            order = orders.create_order(self.session,
+                                        user_id=self.user.user_id,
+                                        quantities={product.id: quantity for product, quantity in cart.values()},
+                                        notes=notes,
+                                        value=value)
+        except orders.OrderError as e:
+            log.warning(f"Order of {self.user} not placed: {e}")
+            self.bot.send_message(self.chat.id, self.loc.get("error_order_products_unavailable"))
+            return
         # Update the user's credit
         self.user.recalculate_credit()
         # Commit all the changes
@@ -796,7 +808,8 @@ class Worker(threading.Thread):
     def __order_notify_admins(self, order):
         # Notify the user of the order result
         self.bot.send_message(self.chat.id, self.loc.get("success_order_created", order=order.text(w=self,
-                                                                                                   user=True)))
+                                                                                                   user=True)),
+                              priority=outbound.ORDER)
         # Notify the admins (in Live Orders mode) of the new order
         admins = self.session.query(db.Admin).filter_by(live_mode=True).all()
         # Create the order keyboard
@@ -811,7 +824,8 @@ class Worker(threading.Thread):
             self.bot.send_message(admin.user_id,
                                   self.loc.get('notification_order_placed',
                                                order=order.text(w=self)),
-                                  reply_markup=order_keyboard)
+                                  reply_markup=order_keyboard,
+                                  priority=outbound.ORDER)
 
     def __order_status(self):
         """Display the status of the sent orders."""
@@ -991,7 +1005,7 @@ class Worker(threading.Thread):
             if self.admin.edit_products:
                 keyboard.append([self.loc.get("menu_products")])
             if self.admin.receive_orders:
-                keyboard.append([self.loc.get("menu_orders")])
+                keyboard.append([self.loc.get("menu_orders"), self.loc.get("menu_export_orders")])
             if self.admin.create_transactions:
                 # if self.cfg["Payments"]["Cash"]["enable_create_transaction"]:
                 #     keyboard.append([self.loc.get("menu_edit_credit")])
@@ -1005,6 +1019,7 @@ class Worker(threading.Thread):
             # Wait for a reply from the user
             selection = self.__wait_for_specific_message([self.loc.get("menu_products"),
                                                           self.loc.get("menu_orders"),
+                                                          self.loc.get("menu_export_orders"),
                                                           self.loc.get("menu_user_mode"),
                                                         #   self.loc.get("menu_edit_credit"),
                                                           self.loc.get("menu_transactions"),
@@ -1018,6 +1033,10 @@ class Worker(threading.Thread):
             elif selection == self.loc.get("menu_orders") and self.admin.receive_orders:
                 # Open the orders menu
                 self.__orders_menu()
+            # If the user has selected the Export orders option and has the privileges to perform the action...
+            elif selection == self.loc.get("menu_export_orders") and self.admin.receive_orders:
+                # Generate the orders file
+                self.__orders_file()
             # If the user has selected the Transactions option and has the privileges to perform the action...
             # elif selection == self.loc.get("menu_edit_credit") and self.admin.create_transactions:
             #     # Open the edit credit menu
@@ -1155,6 +1174,15 @@ class Worker(threading.Thread):
             product.name = name if not isinstance(name, CancelSignal) else product.name
             product.description = description if not isinstance(description, CancelSignal) else product.description
             product.price = price if not isinstance(price, CancelSignal) else product.price
+        # Assign an id to new products, then update the search index in the same transaction
+        self.session.flush()
+        self.search_index.update(self.session, product)
+        # Invalidate the catalogue cached by the API
+        db.CatalogueGeneration.bump(self.session)
+        # Commit the session changes
+        self.session.commit()
+        # Notify the user
+        self.bot.send_message(self.chat.id, self.loc.get("success_product_edited"))
         # If a photo has been sent...
         if isinstance(photo_list, list):
             # Find the largest photo id
@@ -1162,17 +1190,41 @@ class Worker(threading.Thread):
             for photo in photo_list[1:]:
                 if photo.width > largest_photo.width:
                     largest_photo = photo
-                # Get the file object associated with the photo
-                photo_file = self.bot.get_file(largest_photo.file_id)
-                # Notify the user that the bot is downloading the image and might be inactive for a while
-                self.bot.send_message(self.chat.id, self.loc.get("downloading_image"))
-                self.bot.send_chat_action(self.chat.id, action="upload_photo")
-                # Set the image for that product
-                product.set_image(photo_file)
-        # Commit the session changes
-        self.session.commit()
-        # Notify the user
-        self.bot.send_message(self.chat.id, self.loc.get("success_product_edited"))
+            # Get the file object associated with the photo
+            photo_file = self.bot.get_file(largest_photo.file_id)
+            # Download the image in the background, the user is notified when it has been added to the product
+            self.jobs.submit(f"Image of product {product.id}", self.__attach_product_image,
+                             product.id, product.name, photo_file)
+            self.bot.send_message(self.chat.id, self.loc.get("image_download_queued"))
+
+    def __attach_product_image(self, job: jobsm.Job, product_id: int, product_name: str, photo_file: telegram.File):
+        """Download an image and add it to a product. Run by a background job, with its own database session."""
+        session = sqlalchemy.orm.sessionmaker(bind=self.session.get_bind())()
+        try:
+            product = session.query(db.Product).get(product_id)
+            # The product may have been deleted while the job was waiting
+            if product is None or product.deleted:
+                log.info(f"Product {product_id} was deleted before its image could be attached")
+                self.bot.send_message(self.chat.id, self.loc.get("error_product_image_product_deleted",
+                                                                 name=escape(product_name)))
+                return
+            product.set_image(photo_file, self.blob_store, self.variant_maker, self.downloader)
+            # Invalidate the catalogue cached by the API
+            db.CatalogueGeneration.bump(session)
+            session.commit()
+        except DownloadError as e:
+            log.warning(f"Could not download the image of product {product_id}: {e}")
+            self.bot.send_message(self.chat.id, self.loc.get("error_product_image_download",
+                                                             name=escape(product_name)))
+            raise
+        except Exception as e:
+            log.error(f"Could not attach the image of product {product_id}: {e}")
+            self.bot.send_message(self.chat.id, self.loc.get("error_product_image_failed",
+                                                             name=escape(product_name)))
+            raise
+        finally:
+            session.close()
+        self.bot.send_message(self.chat.id, self.loc.get("success_product_image_attached", name=escape(product_name)))
 
     def __delete_product_menu(self):
         log.debug("Displaying __delete_product_menu")
@@ -1197,6 +1249,10 @@ class Worker(threading.Thread):
             product = self.session.query(db.Product).filter_by(name=selection, deleted=False).one()
             # "Delete" the product by setting the deleted flag to true
             product.deleted = True
+            # Remove it from the search results
+            self.search_index.remove(self.session, product.id)
+            # Invalidate the catalogue cached by the API
+            db.CatalogueGeneration.bump(self.session)
             self.session.commit()
             # Notify the user
             self.bot.send_message(self.chat.id, self.loc.get("success_product_deleted"))
@@ -1235,7 +1291,8 @@ class Worker(threading.Thread):
         for order in orders:
             # Send the created message
             self.bot.send_message(self.chat.id, order.text(w=self),
-                                  reply_markup=order_keyboard)
+                                  reply_markup=order_keyboard,
+                                  priority=outbound.ORDER)
         # Set the Live mode flag to True
         self.admin.live_mode = True
         # Commit the change to the database
@@ -1459,54 +1516,129 @@ class Worker(threading.Thread):
                 break
 
     def __transactions_file(self):
-        """Generate a .csv file containing the list of all transactions."""
+        """Generate a .xlsx file containing the list of all transactions."""
         log.debug("Generating __transaction_file")
-        # Retrieve all the transactions
-        transactions = self.session.query(db.Transaction).order_by(db.Transaction.transaction_id).all()
-        # Write on the previously created file
-        with open(f"transactions_{self.chat.id}.csv", "w") as file:
-            # Write an header line
-            file.write(f"UserID;"
-                       f"TransactionValue;"
-                       f"TransactionNotes;"
-                       f"Provider;"
-                       f"ChargeID;"
-                       f"SpecifiedName;"
-                       f"SpecifiedPhone;"
-                       f"SpecifiedEmail;"
-                       f"Refunded?\n")
-            # For each transaction; write a new line on file
-            for transaction in transactions:
-                file.write(f"{transaction.user_id if transaction.user_id is not None else ''};"
-                           f"{transaction.value if transaction.value is not None else ''};"
-                           f"{transaction.notes if transaction.notes is not None else ''};"
-                           f"{transaction.provider if transaction.provider is not None else ''};"
-                           f"{transaction.provider_charge_id if transaction.provider_charge_id is not None else ''};"
-                           f"{transaction.payment_name if transaction.payment_name is not None else ''};"
-                           f"{transaction.payment_phone if transaction.payment_phone is not None else ''};"
-                           f"{transaction.payment_email if transaction.payment_email is not None else ''};"
-                           f"{transaction.refunded if transaction.refunded is not None else ''}\n")
-        # Describe the file to the user
-        self.bot.send_message(self.chat.id, self.loc.get("csv_caption"))
-        # transfer into excel
-        with open(f"transactions_{self.chat.id}.csv", "r", encoding='utf-8') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',')
-            wb = openpyxl.Workbook()
-            ws = wb.active
-            for row in reader:
-                ws.append(row)
-            wb.save(f"transactions_{self.chat.id}.xls")
-        # Reopen the file for reading
-        with open(f"transactions_{self.chat.id}.xls", "rb") as file:
-            document = io.BytesIO(file.read())
-            # Send the file via a manual request to Telegram
-            requests.post(f"https://api.telegram.org/bot{self.cfg['Telegram']['token']}/sendDocument",
-                          files={"document.xlsx": document},
-                          params={"chat_id": self.chat.id,
-                                  "parse_mode": "HTML"})
-        # Delete the created file
-        # os.remove(f"transactions_{self.chat.id}.csv")
-        # os.remove(f"transactions_{self.chat.id}.xlsx")
+        self.__submit_export("Transactions export", exports.export_transactions, {},
+                             "transactions.xlsx", self.loc.get("csv_caption"))
+
+    def __orders_file(self):
+        """Generate a .xlsx or .csv file containing the orders with the status and in the dates chosen by the admin."""
+        log.debug("Displaying __orders_file")
+        # Ask for the status of the orders to export
+        statuses = {self.loc.get("menu_all_orders"): None,
+                    self.loc.get("menu_pending_orders"): "pending",
+                    self.loc.get("menu_delivered_orders"): "delivered",
+                    self.loc.get("menu_refunded_orders"): "refunded"}
+        keyboard = [[status] for status in statuses] + [[self.loc.get("menu_cancel")]]
+        self.bot.send_message(self.chat.id, self.loc.get("conversation_export_orders_status"),
+                              reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True))
+        selection = self.__wait_for_specific_message(list(statuses), cancellable=True)
+        if isinstance(selection, CancelSignal):
+            return
+        status = statuses[selection]
+        # Create an inline keyboard with a single skip button
+        skip = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(self.loc.get("menu_skip"),
+                                                                             callback_data="cmd_cancel")]])
+        # Ask for the range of creation dates until a valid one is specified, skipping it exports every date
+        start, end = None, None
+        while True:
+            self.bot.send_message(self.chat.id, self.loc.get("ask_export_orders_dates"), reply_markup=skip)
+            dates = self.__wait_for_regex(r"(\d{4}-\d{2}-\d{2}\s+\d{4}-\d{2}-\d{2})", cancellable=True)
+            if isinstance(dates, CancelSignal):
+                break
+            try:
+                start, end = (exports.parse_date(date) for date in dates.split())
+            except ValueError:
+                self.bot.send_message(self.chat.id, self.loc.get("error_invalid_dates"))
+                continue
+            if start <= end:
+                break
+            self.bot.send_message(self.chat.id, self.loc.get("error_invalid_dates"))
+        # Ask for the file format
+        formats = {self.loc.get("menu_csv"): "xlsx",
+                   self.loc.get("menu_csv_file"): "csv"}
+        self.bot.send_message(self.chat.id, self.loc.get("conversation_export_orders_format"),
+                              reply_markup=telegram.ReplyKeyboardMarkup([list(formats)], one_time_keyboard=True))
+        file_format = formats[self.__wait_for_specific_message(list(formats))]
+        self.__submit_export("Orders export", exports.export_orders,
+                             {"file_format": file_format, "status": status, "start": start, "end": end},
+                             f"orders.{file_format}", self.loc.get("orders_file_caption"))
+
+    def __submit_export(self, name: str, export: Callable[..., BinaryIO], arguments: Dict[str, Any],
+                        filename: str, caption: str):
+        """Run an export in the background, so that the conversation can go on while the file is generated."""
+        try:
+            self.export_jobs.submit(f"{name} for {self.chat.id}", self.__export_job, export, arguments,
+                                    filename, caption)
+        except jobsm.JobQueueFull:
+            self.bot.send_message(self.chat.id, self.loc.get("error_export_busy"))
+            return
+        self.bot.send_message(self.chat.id, self.loc.get("export_queued"))
+
+    def __export_job(self, job: jobsm.Job, export: Callable[..., BinaryIO], arguments: Dict[str, Any],
+                     filename: str, caption: str):
+        """Generate a file with an export function and send it to the admin. Run by a background job."""
+        # Show the progress of the export, editing the message at most every few seconds.
+        # The progress is only informative: the export goes on without it if it can't be sent or edited.
+        try:
+            message = self.bot.send_message(self.chat.id, self.loc.get("export_progress", percent=0))
+        except telegram.error.TelegramError as e:
+            log.debug(f"Could not send the progress of the export: {e}")
+            message = None
+        last_edit = time.monotonic()
+        last_percent = 0
+
+        def report(progress: float):
+            nonlocal last_edit, last_percent
+            job.report(progress)
+            percent = int(progress * 100)
+            if message is None or percent == last_percent or time.monotonic() - last_edit < EXPORT_PROGRESS_INTERVAL:
+                return
+            last_edit = time.monotonic()
+            last_percent = percent
+            # The admin may have deleted the message
+            try:
+                self.bot.edit_message_text(self.loc.get("export_progress", percent=percent),
+                                           chat_id=self.chat.id, message_id=message.message_id)
+            except telegram.error.BadRequest as e:
+                log.debug(f"Could not update the progress of the export: {e}")
+
+        document = None
+        session = None
+        try:
+            session = sqlalchemy.orm.sessionmaker(bind=self.session.get_bind())()
+            # Write the rows to a temporary file as they are fetched, so generating it runs in constant memory.
+            # The file is deleted once it has been read.
+            with export(session, progress=report, **arguments) as file:
+                size = file.seek(0, os.SEEK_END)
+                # python-telegram-bot 13 reads the whole file in memory to upload it: don't read the files Telegram
+                # would refuse anyway
+                if size <= MAX_DOCUMENT_SIZE:
+                    file.seek(0)
+                    # Read the file once, so that a retried upload doesn't send it from its end
+                    document = telegram.InputFile(file, filename=filename)
+        except Exception:
+            self.bot.send_message(self.chat.id, self.loc.get("error_export_failed"))
+            raise
+        finally:
+            if session is not None:
+                session.close()
+        if message is not None:
+            try:
+                self.bot.delete_message(self.chat.id, message.message_id)
+            except telegram.error.BadRequest as e:
+                log.debug(f"Could not delete the progress of the export: {e}")
+        if document is None:
+            log.warning(f"The export {filename} is too large to be sent: {size} bytes")
+            self.bot.send_message(self.chat.id, self.loc.get("error_export_too_large",
+                                                             size=f"{size / 1024 / 1024:.0f}"))
+            return
+        try:
+            self.bot.send_chat_action(self.chat.id, action="upload_document")
+            self.bot.send_document(self.chat.id, document, caption=caption)
+        except Exception:
+            self.bot.send_message(self.chat.id, self.loc.get("error_export_failed"))
+            raise
 
     def __add_admin(self):
         """Add an administrator to the bot."""
@@ -1662,6 +1794,11 @@ class Worker(threading.Thread):
             # Notify the user that the session has expired and remove the keyboard
             self.bot.send_message(self.chat.id, self.loc.get('conversation_expired'),
                                   reply_markup=telegram.ReplyKeyboardRemove())
+        # If the conversation was closed to make room for new ones...
+        elif stop_trigger.reason == "evicted":
+            # Notify the user that they can start again whenever they want
+            self.bot.send_message(self.chat.id, self.loc.get('conversation_evicted'),
+                                  reply_markup=telegram.ReplyKeyboardRemove())
         # If a restart has been requested...
         # Do nothing.
         # Close the database session